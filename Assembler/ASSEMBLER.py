@@ -1,5 +1,13 @@
 import argparse
+import bisect
+import hashlib
+import itertools
+import mmap
+import operator
+import os
 import re
+import struct
+import time
 from typing import Optional
 import codecs
 
@@ -33,49 +41,654 @@ import codecs
 #    CALL        Branch to memory address register and push program counter to the stack
 #    RET         Return from function poped from stack
 
+#Instruction encodings: mnemonic, opcode, length in bytes, operand syntax, operand fields
+#The opcode is the first byte, each field is (kind, shift, width) within the big-endian instruction
+#    reg         Register R0-R3
+#    pair        Register pair R01 or R23, encoded as 0 or 1
+#    imm         Immediate value
+#    addr        Absolute address
+#    label       Branch target
+ISA = [
+    ("NOP",   0x00, 1, "",                 ()),
+    ("HLT",   0x01, 1, "",                 ()),
+    ("LDI",   0x02, 3, "R{0}, {1}",        (("reg", 8, 2), ("imm", 0, 8))),
+    ("LD",    0x03, 3, "R{0}, {1}",        (("reg", 14, 2), ("addr", 0, 14))),
+    ("ST",    0x04, 3, "R{0}, {1}",        (("reg", 14, 2), ("addr", 0, 14))),
+    ("MOV",   0x05, 2, "R{0}, R{1}",       (("reg", 2, 2), ("reg", 0, 2))),
+    ("ADD",   0x06, 2, "R{0}, R{1}, R{2}", (("reg", 4, 2), ("reg", 2, 2), ("reg", 0, 2))),
+    ("ADC",   0x07, 2, "R{0}, R{1}, R{2}", (("reg", 4, 2), ("reg", 2, 2), ("reg", 0, 2))),
+    ("AND",   0x08, 2, "R{0}, R{1}, R{2}", (("reg", 4, 2), ("reg", 2, 2), ("reg", 0, 2))),
+    ("JMP",   0x09, 3, "{0}",              (("label", 0, 16),)),
+    ("OUT",   0x0A, 2, "R{0}",             (("reg", 0, 2),)),
+    ("CPI",   0x0B, 3, "R{0}, {1}",        (("reg", 8, 2), ("imm", 0, 8))),
+    ("BEQ",   0x0C, 3, "{0}",              (("label", 0, 16),)),
+    ("BGT",   0x0D, 3, "{0}",              (("label", 0, 16),)),
+    ("LDIR",  0x0E, 3, "R{0}, (R{1})",     (("reg", 2, 2), ("reg", 0, 2))),
+    ("STIR",  0x0F, 3, "(R{0}), R{1}",     (("reg", 0, 2), ("reg", 2, 2))),
+    ("LDIRP", 0x10, 2, "R{0}, (R{1})",     (("reg", 4, 2), ("pair", 0, 1))),
+    ("STIRP", 0x11, 2, "(R{0}), R{1}",     (("pair", 0, 1), ("reg", 4, 2))),
+    ("ADDIW", 0x12, 4, "R{0}, {1}",        (("pair", 16, 1), ("imm", 0, 16))),
+    ("ADDI",  0x13, 3, "R{0}, {1}",        (("reg", 8, 2), ("imm", 0, 8))),
+    ("OUTP",  0x14, 2, "R{0}",             (("pair", 0, 1),)),
+    ("OUTA",  0x15, 2, "R{0}",             (("reg", 0, 2),)),
+    ("OR",    0x16, 2, "R{0}, R{1}, R{2}", (("reg", 4, 2), ("reg", 2, 2), ("reg", 0, 2))),
+    ("NOT",   0x17, 2, "R{0}, R{1}",       (("reg", 4, 2), ("reg", 2, 2))),
+    ("XOR",   0x18, 2, "R{0}, R{1}, R{2}", (("reg", 4, 2), ("reg", 2, 2), ("reg", 0, 2))),
+    ("BLT",   0x19, 3, "{0}",              (("label", 0, 16),)),
+    ("CALL",  0x20, 3, "{0}",              (("label", 0, 16),)),
+    ("RET",   0x21, 1, "",                 ()),
+]
+
+#Operand expressions: numbers, symbols, $ for the address of the current instruction,
+#hi()/lo() for the high and low byte, unary - and ~, and binary operators from loosest to tightest
+#    |    &    << >>    + -    * /
+#A lone number or symbol is matched first, operators must follow their left operand on the same line
+EXPRESSION = (rb'((?:0x[0-9a-fA-F]+|\d+|[A-Za-z_]\w*)(?![\w(]|[ \t]*[-+*&|<>)/])'
+              rb'|(?:(?:hi|lo)\s*\(\s*|[-~(]\s*)*(?:0x[0-9a-fA-F]+|\d+|[A-Za-z_]\w*|\$)(?:[ \t]*\))*'
+              rb'(?:[ \t]*(?:<<|>>|[-+*&|]|/(?![/*]))\s*(?:(?:hi|lo)\s*\(\s*|[-~(]\s*)*'
+              rb'(?:0x[0-9a-fA-F]+|\d+|[A-Za-z_]\w*|\$)(?:[ \t]*\))*)*)')
+NUMBER = re.compile(rb'0x[0-9a-fA-F]+|\d+')
+TOKEN = re.compile(rb'\s*(0x[0-9a-fA-F]+|\d+|hi(?=\s*\()|lo(?=\s*\()|[A-Za-z_]\w*|\$|<<|>>|[-+*/&|~()])')
+PRECEDENCE = {b"|": 1, b"&": 2, b"<<": 3, b">>": 3, b"+": 4, b"-": 4, b"*": 5, b"/": 5}
+OPERATORS = {
+    b"|": operator.or_, b"&": operator.and_, b"<<": operator.lshift, b">>": operator.rshift,
+    b"+": operator.add, b"-": operator.sub, b"*": operator.mul, b"/": operator.floordiv,
+    b"neg": operator.neg, b"~": operator.invert,
+    b"hi": lambda a: (a >> 8) & 0xFF, b"lo": lambda a: a & 0xFF,
+}
+
+#Parsed expressions by source text
+EXPRESSIONS = {}
+
+
+#Return the AST of an expression as nested tuples, folded to an int when it uses no symbols
+def parse_expression(text: bytes):
+    if (ast := EXPRESSIONS.get(text)) is not None:
+        return ast
+    #Plain numbers skip the tokenizer
+    if NUMBER.fullmatch(text):
+        ast = int(text, 0)
+    else:
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            if not (m := TOKEN.match(text, pos)):
+                raise SyntaxError(f"Invalid expression: {text.decode()}")
+            tokens.append(m.group(1))
+            pos = m.end()
+        ast, i = parse_binary(tokens, 0, 1)
+        if i != len(tokens):
+            raise SyntaxError(f"Invalid expression: {text.decode()}")
+    EXPRESSIONS[text] = ast
+    return ast
+
+
+#Precedence climbing over tokens starting at i, returns (ast, next token index)
+def parse_binary(tokens: list, i: int, precedence: int) -> tuple:
+    left, i = parse_unary(tokens, i)
+    while i < len(tokens) and PRECEDENCE.get(tokens[i], 0) >= precedence:
+        op = tokens[i]
+        right, i = parse_binary(tokens, i + 1, PRECEDENCE[op] + 1)
+        left = fold((op, left, right))
+    return left, i
+
+
+def parse_unary(tokens: list, i: int) -> tuple:
+    if i >= len(tokens):
+        raise SyntaxError("Incomplete expression")
+    token = tokens[i]
+    if token in (b"-", b"~"):
+        value, i = parse_unary(tokens, i + 1)
+        return fold((b"neg" if token == b"-" else token, value)), i
+    if token in (b"hi", b"lo", b"("):
+        start = i + 1 if token == b"(" else i + 2
+        value, i = parse_binary(tokens, start, 1)
+        if i >= len(tokens) or tokens[i] != b")":
+            raise SyntaxError("Missing ) in expression")
+        return (value if token == b"(" else fold((token, value))), i + 1
+    if token == b"$":
+        return (b"$",), i + 1
+    if token[0] in b"0123456789":
+        return int(token, 0), i + 1
+    if token[0:1].isalpha() or token[0:1] == b"_":
+        return (b"sym", token.decode()), i + 1
+    raise SyntaxError(f"Unexpected {token.decode()} in expression")
+
+
+#Evaluate operator node now if all its operands are constants
+def fold(ast: tuple):
+    if all(type(a) is int for a in ast[1:]):
+        return evaluate(ast, {}, 0)
+    return ast
+
+
+#Return the value of an AST, or None if it uses a symbol that is not defined yet
+def evaluate(ast, symbols: dict, pc: int) -> Optional[int]:
+    if type(ast) is int:
+        return ast
+    op = ast[0]
+    if op == b"sym":
+        return symbols.get(ast[1])
+    if op == b"$":
+        return pc
+    values = [evaluate(a, symbols, pc) for a in ast[1:]]
+    if None in values:
+        return None
+    try:
+        return OPERATORS[op](*values)
+    except ZeroDivisionError:
+        raise SyntaxError("Division by zero in expression")
+    except ValueError:
+        raise SyntaxError("Negative shift count in expression")
+
+
+#Return the symbol names an AST uses, "$" included when it refers to the current address
+def symbol_names(ast) -> tuple:
+    if type(ast) is int:
+        return ()
+    if ast[0] == b"sym":
+        return (ast[1],)
+    if ast[0] == b"$":
+        return ("$",)
+    return tuple(dict.fromkeys(name for a in ast[1:] for name in symbol_names(a)))
+
+
+#Clear a field of the big-endian instruction at offset and write value into it
+def patch_field(output: bytearray, offset: int, length: int, shift: int, mask: int, value: int):
+    word = int.from_bytes(output[offset:offset + length], 'big')
+    word = (word & ~(mask << shift)) | ((value & mask) << shift)
+    output[offset:offset + length] = word.to_bytes(length, 'big')
+
+
+#Raise unless value fits a data value of length bytes, signed or unsigned
+def check_datum(value: int, offset: int, length: int):
+    if not -(1 << 8 * length - 1) <= value < 1 << 8 * length:
+        raise SyntaxError(f"Value {value} at {offset:#06x} does not fit in {length} byte{'s' if length > 1 else ''}")
+
+
+#Macro and .irp bodies refer to parameters as \name, \() separates a parameter from following text
+SUBSTITUTION = re.compile(rb'\\(\w+|\(\))')
+
+#Expanded bodies by (parameters, body, arguments)
+EXPANSIONS = {}
+
+
+#Return body with parameters replaced by arguments, memoized so repeated invocations are substituted once
+def expand(params: tuple, body: bytes, args: tuple) -> bytes:
+    key = (params, body, args)
+    if (text := EXPANSIONS.get(key)) is None:
+        if len(args) > len(params):
+            raise SyntaxError(f"Expected at most {len(params)} arguments, got {len(args)}")
+        values = {name: args[i] if i < len(args) and args[i] else default for i, (name, default) in enumerate(params)}
+        values[b"()"] = b""
+        text = SUBSTITUTION.sub(lambda m: values.get(m.group(1), m.group(0)), body)
+        EXPANSIONS[key] = text
+    return text
+
+
+#Encoded expansions by (parameters, body, arguments) as (code, data, fixups, instructions, expansions), fixups in
+#source order as (data, offset, length, shift, mask, ast) relative to the code or data address the expansion starts at,
+#None for expansions that depend on where or when they are invoked
+REPLAYS = {}
+
+
+#Included files by path, as (mtime, size, digest, contents)
+INCLUDES = {}
+
+
+#Return (digest, contents) of an included file, reading it again only when its mtime or size changed
+def read_include(path: str) -> tuple:
+    try:
+        st = os.stat(path)
+        entry = INCLUDES.get(path)
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            with open(path, "rb") as f:
+                data = f.read()
+            entry = (st.st_mtime_ns, st.st_size, hashlib.blake2b(data, digest_size=16).digest(), data)
+            INCLUDES[path] = entry
+    except OSError as e:
+        raise SyntaxError(f"Cannot include {path}: {e.strerror}")
+    return entry[2], entry[3]
+
+
+#Split comma separated macro arguments
+def split_arguments(text: bytes) -> tuple:
+    text = text.strip()
+    return tuple(a.strip() for a in text.split(b",")) if text else ()
+
+
+#Return the offset of each string in a pool storing equal strings once and a string that ends another as its tail,
+#with the pool itself
+def pool_strings(strings: list) -> tuple:
+    unique = list(dict.fromkeys(strings))
+    #Reversed, a string sorts right before the strings it ends, so walking from the longest tails down
+    #each string only has to be compared with the one before it
+    container = {}
+    previous = None
+    for text in sorted(unique, key=lambda t: t[::-1], reverse=True):
+        if previous is not None and previous.endswith(text):
+            outer, delta = container[previous]
+            container[text] = (outer, delta + len(previous) - len(text))
+        else:
+            container[text] = (text, 0)
+        previous = text
+    #Strings stored whole keep the order they first appeared in
+    starts = {}
+    pool = bytearray()
+    for text in unique:
+        if container[text][0] is text:
+            starts[text] = len(pool)
+            pool += text
+    return [starts[container[t][0]] + container[t][1] for t in strings], bytes(pool)
+
+
+#Operand pattern for each field kind
+OPERANDS = {
+    "reg": rb'(\d+)',
+    "pair": rb'(01|23)',
+    "imm": EXPRESSION,
+    "addr": EXPRESSION,
+    "label": EXPRESSION,
+}
+
+#Expressions already folded to a constant are taken straight from the parse cache
+OPERAND = "v if type(v := EXPRESSIONS.get(t := m.group({g}))) is int else self.operand(v or parse_expression(t), {length}, {shift}, {mask})"
+
+#Addresses are range checked instead of truncated to their field, values that do not fit go to self.address
+ADDRESS = ("v if type(v := EXPRESSIONS.get(t := m.group({g}))) is int and 0 <= v <= {mask} else "
+           "v if 0 <= (v := self.operand(a := v or parse_expression(t), {length}, {shift}, {mask})) <= {mask} else "
+           "self.address(a, v, {length}, {shift}, {mask})")
+
+#Expression converting operand group {g} of match m into its field value
+VALUES = {
+    "reg": "int(m.group({g}))",
+    "pair": "(m.group({g}) == b'23')",
+    "imm": OPERAND,
+    "addr": ADDRESS,
+    "label": ADDRESS,
+}
+
+#(length, shift, mask) of address and label fields, which no immediate or data field shares,
+#so fixups patching them can be range checked too
+ADDRESS_FIELDS = {(length, shift, (1 << width) - 1) for _, _, length, _, fields in ISA
+                  for kind, shift, width in fields if kind in ("addr", "label")}
+
+#(length, shift, mask) of .byte and .word values, which no instruction field shares, so their fixups are range checked
+DATA_FIELDS = {(1, 0, 0xFF), (2, 0, 0xFFFF)}
+
+#Field of LD and ST addresses, which RelaxingParser widens into a register pair sequence
+RELAXABLE = (3, 0, 0x3FFF)
+
+#ISA rows by mnemonic
+INSTRUCTIONS = {row[0]: row for row in ISA}
+
+
+#Return the bytes of an instruction given its operand values in field order
+def encode_instruction(mnemonic: str, *values) -> bytes:
+    _, opcode, length, _, fields = INSTRUCTIONS[mnemonic]
+    word = opcode << 8 * (length - 1)
+    for (_, shift, width), value in zip(fields, values):
+        word |= (value & ((1 << width) - 1)) << shift
+    return word.to_bytes(length, 'big')
+
+
+#Return (pattern, length, encoder) for an ISA row, the encoder is generated as a single expression
+def compile_instruction(mnemonic: str, opcode: int, length: int, syntax: str, fields: tuple) -> tuple:
+    #Instructions without operands end at a word boundary, so NOP2 is left to a macro of that name
+    pattern = mnemonic.encode() + (rb'\s+' if syntax else rb'\b')
+    terms = [f"{opcode << (8 * (length - 1)):#x}"]
+    group = 0
+    for part in re.split(r'(\{\d\})', syntax):
+        if m := re.fullmatch(r'\{(\d)\}', part):
+            group += 1
+            kind, shift, width = fields[int(m.group(1))]
+            mask = (1 << width) - 1
+            pattern += OPERANDS[kind]
+            value = VALUES[kind].format(g=group, length=length, shift=shift, mask=mask)
+            terms.append(f"(({value}) & {mask:#x}) << {shift}")
+        else:
+            pattern += b"".join(rb'\s*,\s*' if c == "," else b"" if c == " " else re.escape(c.encode()) for c in part)
+    namespace = {"EXPRESSIONS": EXPRESSIONS, "parse_expression": parse_expression}
+    exec(f"def encode_{mnemonic}(self, m):\n    return {' | '.join(terms)}\n", namespace)
+    return pattern, length, namespace[f"encode_{mnemonic}"]
+
+
+#Mnemonic to (compiled pattern, length, encoder), filled in by grammar() on first use
+GRAMMAR = {}
+
+
+def grammar() -> dict:
+    if not GRAMMAR:
+        for row in ISA:
+            pattern, length, encode = compile_instruction(*row)
+            GRAMMAR[row[0].encode()] = (re.compile(pattern), length, encode)
+    return GRAMMAR
+
+
+#Directive and skip patterns, compiled once at import
+WHITESPACE = re.compile(rb'\s+')
+LINE_COMMENT = re.compile(rb'(#|//).*[\n$]')
+BLOCK_COMMENT = re.compile(rb'(?s)/\*.*?\*/')
+LABEL = re.compile(rb'([A-Za-z_]\w*):')
+EQU = re.compile(rb'\.equ\s+([A-Za-z_]\w*)\s*,\s*' + EXPRESSION)
+DIRECTIVE = re.compile(rb'\.[a-z]+')
+MACRO = re.compile(rb'\.macro[ \t]+([A-Za-z_]\w*)[ \t]*,?([^\n]*)')
+MACRO_BLOCK = re.compile(rb'\.(?:macro|endm)\b')
+PARAMETER = re.compile(rb'([A-Za-z_]\w*)(?:[ \t]*=[ \t]*([^,\s]*))?')
+REPT = re.compile(rb'\.rept[ \t]+' + EXPRESSION)
+IRP = re.compile(rb'\.irp[ \t]+([A-Za-z_]\w*)[ \t]*,?([^\n]*)')
+REPEAT_BLOCK = re.compile(rb'\.(?:rept|irp|endr)\b')
+DEFINITION = re.compile(rb'\.(?:macro|equ|inc)')
+BLOCK_OPEN = re.compile(rb'\.(?:macro|rept|irp)\b')
+BLOCK_CLOSE = re.compile(rb'\.(?:endm|endr)\b')
+INCLUDE = re.compile(rb'\.include[ \t]+"([^"\n]*)"')
+INCBIN = re.compile(rb'\.incbin[ \t]+"([^"\n]*)"(?:[ \t]*,[ \t]*' + EXPRESSION + rb')?(?:[ \t]*,[ \t]*' + EXPRESSION + rb')?')
+ARGUMENTS = rb'[ \t]+((?:[^\n#/]|/(?![/*]))*)'
+BYTE = re.compile(rb'\.byte' + ARGUMENTS)
+WORD = re.compile(rb'\.word' + ARGUMENTS)
+FILL = re.compile(rb'\.fill' + ARGUMENTS)
+SPACE = re.compile(rb'\.space' + ARGUMENTS)
+ALIGN = re.compile(rb'\.align' + ARGUMENTS)
+ORG = re.compile(rb'\.org' + ARGUMENTS)
+SECTION = re.compile(rb'\.section[ \t]+([A-Za-z_]\w*)(?:[ \t]*,[ \t]*' + EXPRESSION + rb')?')
+TEXT = re.compile(rb'\.text\b')
+POOL = re.compile(rb'\.pool\b')
+NAME = re.compile(rb'([A-Za-z_]\w*)[ \t]*((?:[^\n#/]|/(?![/*]))*)')
+ASCII = re.compile(rb'\.ascii\s+"((?:[^"\\]|\\.)*)"')
+MNEMONIC = re.compile(rb'[A-Z]+')
+UNKNOWN = re.compile(rb'\S+')
+
+#Directive name to (pattern, AssemblyParser method handling the match)
+DIRECTIVES = {
+    b".ascii": (ASCII, "ascii"),
+    b".equ": (EQU, "equ"),
+    b".macro": (MACRO, "macro"),
+    b".rept": (REPT, "rept"),
+    b".irp": (IRP, "irp"),
+    b".include": (INCLUDE, "include"),
+    b".incbin": (INCBIN, "incbin"),
+    b".byte": (BYTE, "byte"),
+    b".word": (WORD, "word"),
+    b".fill": (FILL, "fill_data"),
+    b".space": (SPACE, "space"),
+    b".align": (ALIGN, "align"),
+    b".org": (ORG, "org"),
+    b".section": (SECTION, "section"),
+    b".text": (TEXT, "text"),
+    b".pool": (POOL, "pool"),
+}
+
+
+#Sorted disjoint intervals, an insertion only compares against its neighbours found by bisection
+class IntervalIndex:
+
+    def __init__(self):
+        self.starts = []
+        self.intervals = []
+
+    #Insert (name, start, end) unless it overlaps an interval already present, which is returned instead
+    def add(self, name: str, start: int, end: int) -> Optional[tuple]:
+        i = bisect.bisect_right(self.starts, start)
+        if i > 0 and self.intervals[i - 1][2] > start:
+            return self.intervals[i - 1]
+        if i < len(self.starts) and self.starts[i] < end:
+            return self.intervals[i]
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (name, start, end))
+        return None
+
+
+#Location counters of named sections, outside of them code and data keep the default layout
+class Sections:
+
+    def __init__(self):
+        #Memory layout as name → (origin, size), sections named there take their origin from it
+        self.layout = {}
+        #Named sections as name → [origin, address]
+        self.counters = {}
+        self.current = None
+        #Code address of the default layout while a named section is current
+        self.default_addr = 0
+
+    #Read a memory layout of "name origin size" lines
+    def read_layout(self, layoutFile: str):
+        with open(layoutFile) as f:
+            for line in f:
+                parts = line.split("#")[0].split()
+                if not parts:
+                    continue
+                if len(parts) != 3:
+                    raise SyntaxError(f"Invalid layout line: {line.strip()}")
+                self.layout[parts[0]] = (int(parts[1], 0), int(parts[2], 0))
+
+    #Leave the current section at addr for section name, or the default layout when None, and return where it continues
+    def switch(self, name: Optional[str], origin: Optional[int], addr: int) -> int:
+        if self.current is None:
+            self.default_addr = addr
+        else:
+            self.counters[self.current][1] = addr
+        self.current = name
+        if name is None:
+            return self.default_addr
+        region = self.layout.get(name)
+        if region is not None and origin is not None and origin != region[0]:
+            raise SyntaxError(f"Section {name} at {origin:#06x} conflicts with its layout origin {region[0]:#06x}")
+        counter = self.counters.get(name)
+        if counter is None:
+            if origin is None:
+                if region is None:
+                    raise SyntaxError(f"Section {name} has no origin")
+                origin = region[0]
+            counter = self.counters[name] = [origin, origin]
+        elif origin is not None and origin != counter[0]:
+            raise SyntaxError(f"Section {name} already starts at {counter[0]:#06x}")
+        return counter[1]
+
+    #Return (name, start, end) of every area written, addr is the address of the current section
+    def segments(self, addr: int, code: tuple, data: tuple) -> list:
+        segments = [(".text",) + code, (".data",) + data]
+        for name, (origin, end) in self.counters.items():
+            segments.append((name, origin, addr if name == self.current else end))
+        return [s for s in segments if s[1] < s[2]]
+
+    #Raise on a section larger than its region or on the first two areas that overlap
+    def check(self, addr: int, code: tuple, data: tuple):
+        index = IntervalIndex()
+        for name, start, end in self.segments(addr, code, data):
+            region = self.layout.get(name)
+            if region is not None and end - start > region[1]:
+                raise SyntaxError(f"Section {name} is {end - start} bytes, its region holds {region[1]}")
+            if (other := index.add(name, start, end)) is not None:
+                raise SyntaxError(f"{name} {start:#06x}-{end - 1:#06x} overlaps {other[0]} {other[1]:#06x}-{other[2] - 1:#06x}")
+
 
 class AssemblyParser:
 
+    #Source is read in chunks, keeping at least LOOKAHEAD characters buffered ahead of a token
+    CHUNK_SIZE = 1 << 16
+    LOOKAHEAD = 1 << 12
+    #Deepest nesting of macro expansions and includes, catches recursive macros and includes
+    MAX_DEPTH = 256
+    #Macro invocations copy the encoding of an earlier invocation with the same arguments instead of parsing the body
+    REPLAY = True
+
     #Constructor initializes bytarray, adresses and lable identifiers
     def __init__(self):
         self.output = bytearray(0x10000)
-        self.current_input = ""
+        self.current_input = b""
+        self.pos = 0
+        self.source = None
         self.current_addr = 0
         self.mem_addr = 0x8000
         self.labels = {}
-        self.unresolved = []
+        #Names in labels defined by .equ, which are values rather than addresses
+        self.equates = set()
+        self.unresolved = {}
+        self.verbose = True
+        self.grammar = grammar()
+        #Inputs interrupted by an expansion, as (input, pos, source, file, texts still to expand)
+        self.inputs = []
+        self.macros = {}
+        self.expansions = 0
+        #File being parsed, includes are looked up next to it
+        self.file = None
+        self.dependencies = {}
+        self.sections = Sections()
+        #Where the default data area starts, taken at its first write
+        self.data_start = None
+        #With pooling, .ascii strings wait for .pool or the end of the program as (data, labels naming them)
+        self.pooling = False
+        self.strings = []
+        self.string_labels = []
+        #Tokens that matched nothing, a macro defined later under one of these names was used before its definition
+        self.unknown_words = set()
 
-    #Open file and parse each part
+    #Parse file and write the assembled image
     def parse_file(self, file: str, outFile: str):
-        with open(file, "r") as i:
-            self.current_input = i.read()
-        self.parse_program()
+        with open(file, "rb") as i:
+            self.read_file(i)
+            self.parse_program()
+            self.close_file()
         self.resolve_labels()
+        self.write_file(outFile)
+
+    #Map file into memory so the bytes are parsed in place
+    def read_file(self, i):
+        self.file = i.name
+        self.dependencies[i.name] = None
+        try:
+            self.current_input = mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            #Empty files and pipes cannot be mapped, stream them chunk by chunk instead
+            self.source = i
+            self.current_input = b""
+        self.pos = 0
+
+    def close_file(self):
+        if isinstance(self.current_input, mmap.mmap):
+            self.current_input.close()
+        self.source = None
         self.current_input = None
+
+    def write_file(self, outFile: str):
         with open(outFile,"wb") as f:
             f.write(self.output)
-        print(f"Wrote {len(self.output)} bytes to {outFile}")
+        if self.verbose:
+            print(f"Wrote {len(self.output)} bytes to {outFile}")
+
+    #Write label table as "address name" lines sorted by address, for debuggers and disassemblers, .equ constants
+    #are left out as they name values rather than addresses
+    def write_map(self, mapFile: str):
+        with open(mapFile, "w") as f:
+            for label, addr in sorted(self.labels.items(), key=lambda item: item[1]):
+                if label not in self.equates:
+                    f.write(f"{addr:04x} {label}\n")
+
+    #Write a make rule listing the sources and included files the output depends on
+    def write_dependencies(self, outFile: str, depFile: str):
+        escape = lambda path: path.replace(" ", "\\ ")
+        with open(depFile, "w") as f:
+            f.write(f"{escape(outFile)}: " + " ".join(escape(path) for path in self.dependencies) + "\n")
 
     #While there is an input parse individual instruction
     def parse_program(self):
-        while len(self.current_input) > 0:
+        while self.has_input():
             self.parse_instruction()
 
+    #Top up the buffer so a token never straddles a chunk boundary, stepping out of finished expansions
+    def has_input(self) -> bool:
+        while True:
+            while len(self.current_input) - self.pos < self.LOOKAHEAD and self.fill():
+                pass
+            if self.pos < len(self.current_input):
+                return True
+            if not self.inputs:
+                return False
+            self.next_input()
+
+    #Parse texts one after another before resuming the current input, file is set while parsing an include
+    def push_input(self, texts, file: Optional[str] = None):
+        if len(self.inputs) >= self.MAX_DEPTH:
+            raise SyntaxError("Macros or includes nested too deeply")
+        self.inputs.append((self.current_input, self.pos, self.source, self.file, iter(texts)))
+        self.current_input = b""
+        self.pos = 0
+        self.source = None
+        self.file = file or self.file
+
+    #Continue with the next text of the innermost expansion, or resume the input it interrupted
+    def next_input(self):
+        current_input, pos, source, file, texts = self.inputs[-1]
+        text = next(texts, None)
+        if text is None:
+            self.inputs.pop()
+            self.current_input, self.pos, self.source, self.file = current_input, pos, source, file
+            return
+        #\@ numbers each expansion so macros can define local labels
+        if b"\\@" in text:
+            text = text.replace(b"\\@", b"%d" % self.expansions)
+        self.expansions += 1
+        self.current_input = text
+        self.pos = 0
+
+    #Consume input up to the directive closing the block just opened and return the text before it
+    def consume_body(self, pattern: re.Pattern, closing: bytes) -> bytes:
+        depth = 1
+        scan = self.pos
+        while True:
+            m = pattern.search(self.current_input, scan)
+            #Closing directive may lie, or straddle, past the buffered input
+            if (m is None or m.end() == len(self.current_input)) and self.source is not None:
+                scan -= self.pos
+                self.fill()
+                scan += self.pos
+                continue
+            if m is None:
+                raise SyntaxError(f"Missing {closing.decode()}")
+            depth += -1 if m.group(0) == closing else 1
+            scan = m.end()
+            if depth == 0:
+                body = bytes(self.current_input[self.pos:m.start()])
+                self.pos = m.end()
+                return body
+
+    #Drop consumed input and append the next chunk, False once the source is exhausted
+    def fill(self) -> bool:
+        if self.source is None:
+            return False
+        chunk = self.source.read(self.CHUNK_SIZE)
+        if not chunk:
+            self.source = None
+            return False
+        #Chunks end at the end of a line, a token ends on its line so it is never cut short by the buffer end
+        if not chunk.endswith(b"\n"):
+            chunk += self.source.readline()
+        self.current_input = self.current_input[self.pos:] + chunk
+        self.pos = 0
+        return True
+
     #Skip over whitespace, and comments        
     def skip(self):
-        while True:
-            if m := self.consume_regex(r'\s+'):
+        while self.has_input():
+            if m := self.consume_regex(WHITESPACE):
+                continue
+            if m := self.consume_regex(LINE_COMMENT):
                 continue
-            if m := self.consume_regex(r'(#|//).*[\n$]'):
+            if m := self.consume_regex(BLOCK_COMMENT):
                 continue
-            if m := self.consume_regex(r'(?s)/\*.*\*/'):
+            #Block comment runs past the buffered input
+            if self.current_input[self.pos:self.pos + 2] == b"/*" and self.fill():
                 continue
             break
     
-    #Return regular expression
-    def consume_regex(self, regex) -> Optional[re.Match]:
-        if m := re.match(regex,self.current_input):
-            self.current_input = self.current_input[len(m[0]):]
+    #Match compiled pattern at the current position and consume it
+    def consume_regex(self, pattern: re.Pattern) -> Optional[re.Match]:
+        m = pattern.match(self.current_input, self.pos)
+        #Match reaching the end of the buffer may continue in the next chunk
+        while m and m.end() == len(self.current_input) and self.fill():
+            m = pattern.match(self.current_input, self.pos)
+        if m:
+            self.pos = m.end()
             return m
         return None
     
@@ -84,392 +697,1197 @@ class AssemblyParser:
         self.skip()
         
         #Identify labels
-        if m:= self.consume_regex(r'([A-Za-z_]\w*):'):
-            label = m.group(1)
-            self.labels[label] = self.current_addr
-            print(f"Label {label} defined at address {self.current_addr}")
+        if m:= self.consume_regex(LABEL):
+            label = m.group(1).decode()
+            if self.pooling:
+                self.string_label(label)
+                return
+            self.define_label(label)
             return 
         
-        #Encode ascii values at index
-        if m := self.consume_regex(r'\.ascii\s+"((?:[^"\\]|\\.)*)"'):
-            s = bytes(m.group(1), "utf-8").decode("unicode_escape") 
-            data = s.encode('ascii')
-            for i in data:
-                self.output[self.mem_addr] += i
-                self.mem_addr += 1
-            print(f'.ascii "{s}" → {list(data)}')
-            return
-        
-        #LDI Rd, 0xImm
-        if m := self.consume_regex(r'LDI\s+[R](\d+)\s*,\s*(0x[0-9a-fA-F]+|\d+)'):
-            reg = int(m.group(1))
-            imm_str = m.group(2)
-            imm = int(imm_str,0)
-            op = 0x020000
-            op |= ((reg & 0x03) << 8)
-            op |= (imm & 0xFF)
-            op &= 0xFFFFFF
-            code = op.to_bytes(3,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #LD Rd, 0xAddress
-        if m := self.consume_regex(r'LD\s+[R](\d+)\s*,\s*(0x[0-9a-fA-F]+|\d+)\s*'):
-            reg = int(m.group(1))
-            addr_str = m.group(2)
-            addr = int(addr_str,0)
-            addr &= 0x3FFF
-            op = 0x030000
-            op |= ((reg & 0x03) << 14)
-            op |= addr
-            op &= 0xFFFFFF
-            code = op.to_bytes(3,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #St Rx, 0xAddress
-        if m := self.consume_regex(r'ST\s+[R](\d+)\s*,\s*(0x[0-9a-fA-F]+|\d+)\s*'):
-            reg = int(m.group(1))
-            addr_str = m.group(2)
-            addr = int(addr_str,0)
-            addr &= 0x3FFF
-            op = 0x040000
-            op |= ((reg & 0x03) << 14)
-            op |= addr
-            op &= 0xFFFFFF
-            code = op.to_bytes(3,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
+        #Instructions dispatched on their mnemonic
+        if m := MNEMONIC.match(self.current_input, self.pos):
+            if instruction := self.grammar.get(m.group(0)):
+                pattern, length, encode = instruction
+                if m := self.consume_regex(pattern):
+                    self.emit(encode(self, m), length)
+                    return
         
-        #ADD Rd, Rx, Ry
-        if m := self.consume_regex(r'ADD\s+R(\d+)\s*,\s*R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            reg3 = int(m.group(3))
-            op = 0x0600
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2) | (reg3 & 0x03)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
+        #Directives dispatched on their name
+        if m := DIRECTIVE.match(self.current_input, self.pos):
+            if directive := DIRECTIVES.get(m.group(0)):
+                pattern, handler = directive
+                #Strings may span lines, they are buffered up to their closing quote
+                if pattern is ASCII:
+                    while not ASCII.match(self.current_input, self.pos) and self.fill():
+                        pass
+                if m := self.consume_regex(pattern):
+                    getattr(self, handler)(m)
+                    return
         
-        #ADC Rd, Rx, Ry
-        if m := self.consume_regex(r'ADC\s+R(\d+)\s*,\s*R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            reg3 = int(m.group(3))
-            op = 0x0700
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2) | (reg3 & 0x03)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
+        #Macro invocation with comma separated arguments up to the end of the line
+        if self.macros and (m := NAME.match(self.current_input, self.pos)) and m.group(1) in self.macros:
+            self.invoke(self.consume_regex(NAME))
             return
         
-        #OUT Rx
-        if m := self.consume_regex(r'OUT\s+R(\d+)'):
-            reg = int(m.group(1))
-            op = 0x0A00
-            op |= (reg & 0x03)
-            op &= (op & 0xFFFF)
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #CPI Rx, 0xImm
-        if m := self.consume_regex(r'CPI\s+[R](\d+)\s*,\s*(0x[0-9a-fA-F]+|\d+)'):
-            reg = int(m.group(1))
-            imm_str = m.group(2)
-            imm = int(imm_str,0)
-            op = 0x0B0000
-            op |= ((reg & 0x03) << 8)
-            op |= (imm & 0xFF)
-            op &= 0xFFFFFF
-            code = op.to_bytes(3,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #BGT MAR
-        if m := self.consume_regex(r'BGT\s+([A-Za-z_]\w*)'):
-            label = m.group(1)
-            op = 0x0D0000 
-            self.unresolved.append((label, self.current_addr))
-            code = op.to_bytes(3,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #BEQ MAR
-        if m := self.consume_regex(r'BEQ\s+([A-Za-z_]\w*)'):
-            label = m.group(1)
-            op = 0x0C0000 
-            self.unresolved.append((label, self.current_addr))
-            code = op.to_bytes(3,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #JMP MAR
-        if m := self.consume_regex(r'JMP\s+([A-Za-z_]\w*)'):
-            label = m.group(1)
-            op = 0x090000 
-            self.unresolved.append((label, self.current_addr))
-            code = op.to_bytes(3,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #MOV Rd, Rx
-        if m := self.consume_regex(r'MOV\s+R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            op = 0x0500
-            op |= ((reg1 & 0x03 ) << 2) | (reg2 & 0x03) 
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #HLT
-        if m := self.consume_regex(r'HLT'):
-            op = 0x01
-            code = op.to_bytes(1,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #NOP
-        if m := self.consume_regex(r'NOP'):
-            op = 0x00
-            code = op.to_bytes(1,byteorder='big')
-            self.output += code
-            return
+        #Unknown token
+        unknown = self.consume_regex(UNKNOWN)
+        if unknown:
+            self.unknown_words.add(unknown.group(0))
+            self.unknown_token(unknown)
+
+    #Expand the macro named by m with the arguments following it
+    def invoke(self, m: re.Match):
+        params, body = self.macros[m.group(1)]
+        args = split_arguments(m.group(2))
+        if self.REPLAY and self.sections.current is None and not self.pooling:
+            key = (params, body, args)
+            replay = REPLAYS.get(key, False)
+            if replay is False:
+                replay = REPLAYS[key] = self.record(expand(params, body, args))
+            if replay is not None:
+                self.replay(replay)
+                if self.verbose:
+                    print(f"Macro {m.group(1).decode()} replayed → {len(replay[0])} code and {len(replay[1])} data bytes")
+                return
+        self.push_input((expand(params, body, args),))
+
+    #Encode an expansion at the current addresses, None unless it only emits instructions and data that do not depend
+    #on the addresses, the labels or the macros defined so far
+    def record(self, text: bytes) -> Optional[tuple]:
+        if b"\\@" in text or DEFINITION.search(text):
+            return None
+        bases = (self.current_addr, self.mem_addr)
+        p = LineParser(text, {}, 0, self.file, {}, bases)
+        try:
+            p.parse_program()
+        except SyntaxError:
+            #Reported where the expansion is parsed
+            return None
+        if p.labels or p.unknown or p.needed or p.anchored or p.switch is not None or p.dependencies:
+            return None
+        code, data = iter(p.fixups), iter(p.data_fixups)
+        fixups = tuple((is_data,) + next(data if is_data else code)[:5] for is_data in p.order)
+        return (bytes(p.output[p.code_base:p.current_addr]), bytes(p.output[p.data_base:p.mem_addr]), fixups,
+                p.emitted, p.expansions)
+
+    #Write a recorded expansion at the current addresses, patching or deferring its symbolic operands and data
+    def replay(self, replay: tuple):
+        code, data, fixups, _, expansions = replay
+        pc = self.current_addr
+        end = pc + len(code)
+        if end > len(self.output):
+            raise SyntaxError("Program does not fit in memory")
+        self.output[pc:end] = code
+        data_pc = self.mem_addr
+        if data:
+            self.write_data(data)
+        #The invocation and the repetitions inside it number \@ labels of later expansions
+        self.expansions += 1 + expansions
+        for is_data, offset, length, shift, mask, ast in fixups:
+            offset += data_pc if is_data else pc
+            value = evaluate(ast, self.labels, offset)
+            if value is None:
+                self.defer((offset, length, shift, mask, ast))
+                continue
+            if (length, shift, mask) in ADDRESS_FIELDS:
+                self.check_address(value, offset, length, shift, mask)
+            elif (length, shift, mask) in DATA_FIELDS:
+                check_datum(value, offset, length)
+            patch_field(self.output, offset, length, shift, mask, value)
+        self.current_addr = end
         
-        #LDIR Rd, (Rx)
-        if m := self.consume_regex(r'LDIR\s+R(\d+)\s*,\s*\(R(\d+)\)'):
-            rd = int(m.group(1)) & 0x03
-            ra = int(m.group(2)) & 0x03
-            op = 0x0E0000
-            op |= ((ra & 0x03))      
-            op |= ((rd & 0x03) << 2) 
-            code = op.to_bytes(3, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
+    #Encode ascii values at index
+    def ascii(self, m: re.Match):
+        data = m.group(1)
+        #Only literals with escapes or non-ascii bytes need decoding
+        if b"\\" in data or not data.isascii():
+            try:
+                data = data.decode("unicode_escape").encode('ascii')
+            except UnicodeError as e:
+                raise SyntaxError(f'Invalid .ascii "{m.group(1).decode(errors="replace")}": {e.reason}')
+        if self.pooling:
+            self.strings.append((data, self.string_labels))
+            self.string_labels = []
             return
+        self.write_data(data)
+        if self.verbose:
+            print(f'.ascii "{data.decode("ascii")}" → {list(data)}')
 
-        #STIR (Rx), Ry 
-        if m := self.consume_regex(r'STIR\s+\(R(\d+)\)\s*,\s*R(\d+)'):
-            ra = int(m.group(1)) & 0x03
-            rb = int(m.group(2)) & 0x03
-            op = 0x0F0000
-            op |= ((ra & 0x03))
-            op |= ((rb & 0x03) << 2)
-            code = op.to_bytes(3, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
+    #With pooling, a label right before an .ascii, or a chain of them, names the string rather than the code address
+    #it appears at, and is defined once the pool is laid out
+    def string_label(self, label):
+        labels = [label]
+        self.skip()
+        while m := self.consume_regex(LABEL):
+            labels.append(m.group(1).decode())
+            self.skip()
+        if self.current_input[self.pos:self.pos + 6] != b".ascii":
+            for label in labels:
+                self.define_label(label)
             return
+        if self.verbose:
+            print(f"{'Labels' if len(labels) > 1 else 'Label'} {', '.join(labels)} "
+                  f"{'name' if len(labels) > 1 else 'names'} the pooled string after it, not code address {self.current_addr:#06x}")
+        self.string_labels += labels
 
-        #LDIRP Rd, (Rp)
-        if m := self.consume_regex(r'LDIRP\s+R(\d+)\s*,\s*\(R(01|23)\)'):
-            rd = int(m.group(1)) & 0x03
-            pair = 0 if m.group(2) == "01" else 1
-            op = 0x1000
-            op |= ((rd & 0x03) << 4)
-            op |= pair
-            code = op.to_bytes(2, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
-            return
+    #.pool lays out the strings pooled so far at the data address
+    def pool(self, m: re.Match):
+        self.flush_strings()
 
-        #STIRP (R0), Ry
-        if m := self.consume_regex(r'STIRP\s+\(R(01|23)\)\s*,\s*R(\d+)'):
-            pair = 0 if m.group(1) == "01" else 1
-            rs = int(m.group(2)) & 0x03
-            op = 0x1100
-            op |= ((rs & 0x03) << 4)
-            op |= pair
-            code = op.to_bytes(2, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
+    #Write the pooled strings once, sharing equal strings and tails, and define the labels naming them
+    def flush_strings(self):
+        if not self.strings:
             return
+        offsets, data = pool_strings([text for text, _ in self.strings])
+        addr = self.data_addr()
+        self.write_data(data)
+        for (text, labels), offset in zip(self.strings, offsets):
+            for label in labels:
+                self.define_symbol(label, addr + offset)
+        if self.verbose:
+            print(f"Pooled {len(self.strings)} strings into {len(data)} bytes at {addr:#06x}, "
+                  f"saving {sum(len(text) for text, _ in self.strings) - len(data)}")
+        self.strings = []
 
-        #ADDIW Rp, 0xImm16
-        if m := self.consume_regex(r'ADDIW\s+R(01|23)\s*,\s*(0x[0-9A-Fa-f]+|\d+)'):
-            pair = 0 if m.group(1) == "01" else 1
-            imm = int(m.group(2), 0) & 0xFFFF
-            op = 0x12000000
-            op |= (pair << 16)
-            op |= imm
-            code = op.to_bytes(4, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
-            return
+    #.equ NAME, expression
+    def equ(self, m: re.Match):
+        self.define_constant(m.group(1).decode(), m.group(2))
 
-        #ADDI Rd, 0xImm8
-        if m := self.consume_regex(r'ADDI\s+R(\d+)\s*,\s*(0x[0-9A-Fa-f]+|\d+)'):
-            rd = int(m.group(1)) & 0x03
-            imm = int(m.group(2), 0) & 0xFF
-            op = 0x130000
-            op |= (rd << 8) 
-            op |= imm
-            code = op.to_bytes(3, byteorder='big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
-            return
+    #.macro NAME param, param=default ... .endm
+    def macro(self, m: re.Match):
+        if m.group(1) in self.unknown_words:
+            raise SyntaxError(f"{m.group(1).decode()} is used before its definition")
+        params = tuple((name, default or b"") for name, default in PARAMETER.findall(m.group(2)))
+        self.macros[m.group(1)] = (params, self.consume_body(MACRO_BLOCK, b".endm"))
+        if self.verbose:
+            print(f"Macro {m.group(1).decode()} defined with {len(params)} parameters")
 
-        #OUTP Rp
-        if m := self.consume_regex(r'OUTP\s+R(01|23)'):
-            pair = 0 if m.group(1) == "01" else 1
-            op = 0x1400 | pair
-            code = op.to_bytes(2, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
-            return
+    #.rept count ... .endr, the count must be known where it appears
+    def rept(self, m: re.Match):
+        count = self.constant(m.group(1), ".rept", self.current_addr)
+        self.push_input(itertools.repeat(self.consume_body(REPEAT_BLOCK, b".endr"), max(count, 0)))
 
-        #OUTA Rx
-        if m := self.consume_regex(r'OUTA\s+R(\d+)'):
-            ra = int(m.group(1)) & 0x03
-            op = 0x1500 | ra
-            code = op.to_bytes(2, 'big')
-            for i in code:
-                self.output[self.current_addr] = i
-                self.current_addr += 1
-            return
-        
-        #AND Rd, Rx, Ry
-        if m := self.consume_regex(r'AND\s+R(\d+)\s*,\s*R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            reg3 = int(m.group(3))
-            op = 0x0800
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2) | (reg3 & 0x03)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #OR Rd, Rx, Ry
-        if m := self.consume_regex(r'OR\s+R(\d+)\s*,\s*R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            reg3 = int(m.group(3))
-            op = 0x1600
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2) | (reg3 & 0x03)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #XOR Rd, Rx, Ry
-        if m := self.consume_regex(r'XOR\s+R(\d+)\s*,\s*R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            reg3 = int(m.group(3))
-            op = 0x1800
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2) | (reg3 & 0x03)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #Not Rd, Rx
-        if m := self.consume_regex(r'NOT\s+R(\d+)\s*,\s*R(\d+)'):
-            reg1 = int(m.group(1))
-            reg2 = int(m.group(2))
-            op = 0x1700
-            op |= ((reg1 & 0x03 ) << 4) | ((reg2 & 0x03) << 2)
-            op &= 0xFFFF
-            code = op.to_bytes(2,byteorder='big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #BLT MAR
-        if m := self.consume_regex(r'BLT\s+([A-Za-z_]\w*)'):
-            label = m.group(1)
-            op = 0x190000 
-            self.unresolved.append((label, self.current_addr))
-            code = op.to_bytes(3,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
-            return
-        
-        #CALL MAR
-        if m := self.consume_regex(r'CALL\s+([A-Za-z_]\w*)'):
-            label = m.group(1)
-            op = 0x200000  
-            self.unresolved.append((label, self.current_addr))
-            code = op.to_bytes(3,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
+    #.irp param, value, value ... .endr repeats the body once per value
+    def irp(self, m: re.Match):
+        params = ((m.group(1), b""),)
+        body = self.consume_body(REPEAT_BLOCK, b".endr")
+        self.push_input(expand(params, body, (value,)) for value in split_arguments(m.group(2)))
+
+    #Resolve an included name relative to the including file, falling back to the working directory
+    def include_path(self, name: bytes) -> str:
+        name = os.fsdecode(name)
+        if self.file is not None and not os.path.isabs(name):
+            path = os.path.join(os.path.dirname(self.file), name)
+            if os.path.exists(path):
+                return path
+        return name
+
+    #.include "file" parses the file in place
+    def include(self, m: re.Match):
+        path = self.include_path(m.group(1))
+        digest, data = read_include(path)
+        self.dependencies[path] = digest
+        self.push_input((data,), path)
+
+    #.incbin "file", skip, count copies the file, or part of it, into the data area
+    def incbin(self, m: re.Match):
+        path = self.include_path(m.group(1))
+        digest, data = read_include(path)
+        self.dependencies[path] = digest
+        pc = self.data_addr()
+        skip = self.constant(m.group(2), ".incbin", pc) if m.group(2) else 0
+        count = self.constant(m.group(3), ".incbin", pc) if m.group(3) else len(data)
+        blob = memoryview(data)[skip:skip + count]
+        self.write_data(blob)
+        if self.verbose:
+            print(f'.incbin "{path}" → {len(blob)} bytes')
+
+    #.byte expression, ... one byte each
+    def byte(self, m: re.Match):
+        self.data_values(m.group(1), 1)
+
+    #.word expression, ... big-endian like the instruction encoding
+    def word(self, m: re.Match):
+        self.data_values(m.group(1), 2)
+
+    #.fill count, size, value repeats a big-endian value of size bytes, size defaults to 1 and value to 0
+    def fill_data(self, m: re.Match):
+        args = split_arguments(m.group(1))
+        pc = self.data_addr()
+        count = self.constant(args[0], ".fill", pc)
+        size = self.constant(args[1], ".fill", pc) if len(args) > 1 and args[1] else 1
+        value = self.constant(args[2], ".fill", pc) if len(args) > 2 else 0
+        if count < 0:
+            raise SyntaxError(f".fill count must not be negative, got {count}")
+        if not 1 <= size <= 8:
+            raise SyntaxError(f".fill size must be 1 to 8 bytes, got {size}")
+        check_datum(value, pc, size)
+        self.reserve(count * size)
+        self.write_data((value & ((1 << 8 * size) - 1)).to_bytes(size, 'big') * count)
+
+    #.space size, value reserves size bytes of value, 0 by default
+    def space(self, m: re.Match):
+        args = split_arguments(m.group(1))
+        pc = self.data_addr()
+        size = self.constant(args[0], ".space", pc)
+        value = self.constant(args[1], ".space", pc) if len(args) > 1 else 0
+        if size < 0:
+            raise SyntaxError(f".space size must not be negative, got {size}")
+        check_datum(value, pc, 1)
+        self.reserve(size)
+        self.write_data(bytes([value & 0xFF]) * size)
+
+    #.align boundary, value pads the data address to a multiple of boundary
+    def align(self, m: re.Match):
+        args = split_arguments(m.group(1))
+        pc = self.data_addr()
+        boundary = self.constant(args[0], ".align", pc)
+        value = self.constant(args[1], ".align", pc) if len(args) > 1 else 0
+        if boundary <= 0:
+            raise SyntaxError(f".align boundary must be positive, got {boundary}")
+        check_datum(value, pc, 1)
+        self.reserve(-pc % boundary)
+        self.write_data(bytes([value & 0xFF]) * (-pc % boundary))
+
+    #.org address moves the data address, or the address of the current section, forward, zero filling the gap
+    def org(self, m: re.Match):
+        pc = self.data_addr()
+        addr = self.constant(m.group(1), ".org", pc)
+        if addr < pc:
+            raise SyntaxError(f".org {addr:#06x} is behind the data address {pc:#06x}")
+        self.reserve(addr - pc)
+        self.write_data(bytes(addr - pc))
+
+    #.section NAME, origin sends code and data to a named section, the origin may come from the memory layout
+    def section(self, m: re.Match):
+        origin = self.constant(m.group(2), ".section", self.current_addr) if m.group(2) else None
+        self.switch_section(m.group(1).decode(), origin)
+
+    #.text returns to the default layout, code from 0 and data from 0x8000
+    def text(self, m: re.Match):
+        self.switch_section(None, None)
+
+    def switch_section(self, name: Optional[str], origin: Optional[int]):
+        self.current_addr = self.sections.switch(name, origin, self.current_addr)
+        if self.verbose:
+            print(f"Section {name or '.text'} continues at address {self.current_addr:#06x}")
+
+    #Data follows the code inside a named section
+    def data_addr(self) -> int:
+        return self.mem_addr if self.sections.current is None else self.current_addr
+
+    #Write comma separated expressions as big-endian values of size bytes with a single slice write
+    def data_values(self, text: bytes, size: int):
+        values = [parse_expression(t) for t in split_arguments(text)]
+        addr = self.data_addr()
+        mask = (1 << 8 * size) - 1
+        for i, value in enumerate(values):
+            if type(value) is not int:
+                values[i] = self.datum(value, addr + i * size, size)
+            else:
+                check_datum(value, addr + i * size, size)
+        self.write_data(struct.pack(f">{len(values)}{'B' if size == 1 else 'H'}", *(v & mask for v in values)))
+
+    #Check that size bytes of padding fit at the data address before they are built
+    def reserve(self, size: int):
+        if self.data_addr() + size > len(self.output):
+            raise SyntaxError("Program does not fit in memory")
+
+    #Copy bytes to the data address and advance it
+    def write_data(self, data):
+        if self.sections.current is not None:
+            end = self.current_addr + len(data)
+            if end > len(self.output):
+                raise SyntaxError("Program does not fit in memory")
+            self.output[self.current_addr:end] = data
+            self.current_addr = end
             return
-        
-        #RET
-        if m := self.consume_regex(r'RET'):
-            op = 0x21
-            code = op.to_bytes(1,'big')
-            for i in code:
-                self.output[self.current_addr] += i
-                self.current_addr += 1
+        if self.data_start is None:
+            self.data_start = self.mem_addr
+        end = self.mem_addr + len(data)
+        if end > len(self.output):
+            raise SyntaxError("Program does not fit in memory")
+        self.output[self.mem_addr:end] = data
+        self.mem_addr = end
+
+    #Value of a directive argument that must be known where it appears, $ is pc
+    def constant(self, text: bytes, directive: str, pc: int) -> int:
+        value = evaluate(parse_expression(text), self.labels, pc)
+        if value is None:
+            raise SyntaxError(f"Undefined symbol in {directive} {text.decode().strip()}")
+        return value
+
+    #Report token that matched no instruction or directive
+    def unknown_token(self, m: re.Match):
+        if self.verbose:
+            print(f"Unknown token: {m.group(0).decode(errors='replace')}")
+
+    #Write op as a big-endian instruction of length bytes at the current address
+    def emit(self, op: int, length: int):
+        end = self.current_addr + length
+        if end > len(self.output):
+            raise SyntaxError("Program does not fit in memory")
+        self.output[self.current_addr:end] = op.to_bytes(length, 'big')
+        self.current_addr = end
+
+    def define_label(self, label):
+        if self.verbose:
+            print(f"Label {label} defined at address {self.current_addr}")
+        self.define_symbol(label, self.current_addr)
+
+    #Constants must be computable from symbols defined before them
+    def define_constant(self, name, text: bytes):
+        self.equates.add(name)
+        self.define_symbol(name, self.constant(text, f".equ {name},", self.current_addr))
+
+    #Add symbol and patch the fixups chained on it, a name is defined once so every reference means the same address
+    def define_symbol(self, name, value: int):
+        if name in self.labels:
+            raise SyntaxError(f"{name} is defined more than once")
+        self.labels[name] = value
+        for fixup in self.unresolved.pop(name, ()):
+            self.resolve_fixup(name, fixup)
+
+    #Return the value of a symbolic operand, or 0 with a fixup chained on its first undefined symbol
+    def operand(self, ast: tuple, length: int, shift: int, mask: int) -> int:
+        if type(ast) is int:
+            return ast
+        #Most symbolic operands are a bare label
+        value = self.labels.get(ast[1]) if ast[0] == b"sym" else evaluate(ast, self.labels, self.current_addr)
+        if value is None:
+            self.defer((self.current_addr, length, shift, mask, ast))
+            return 0
+        return value
+
+    #Address or label operand whose value does not fit its field
+    def address(self, ast, value: int, length: int, shift: int, mask: int) -> int:
+        self.check_address(value, self.current_addr, length, shift, mask)
+        return value
+
+    def check_address(self, value: int, offset: int, length: int, shift: int, mask: int):
+        if not 0 <= value <= mask:
+            raise SyntaxError(f"Address {value:#06x} at {offset:#06x} does not fit its {mask.bit_length()}-bit field")
+
+    #Return the value of a data expression stored at addr, or 0 with a fixup chained on its first undefined symbol
+    def datum(self, ast: tuple, addr: int, length: int) -> int:
+        value = evaluate(ast, self.labels, addr)
+        if value is None:
+            self.defer((addr, length, 0, (1 << 8 * length) - 1, ast))
+            return 0
+        return value
+
+    def defer(self, fixup: tuple):
+        ast = fixup[4]
+        if ast[0] == b"sym":
+            name = ast[1]
+        else:
+            name = next(n for n in symbol_names(ast) if n != "$" and n not in self.labels)
+        self.unresolved.setdefault(name, []).append(fixup)
+
+    #Patch fixup once the symbol it waited on is defined, or chain it on the next undefined one
+    def resolve_fixup(self, name, fixup: tuple):
+        offset, length, shift, mask, ast = fixup
+        value = evaluate(ast, self.labels, offset)
+        if value is None:
+            self.defer(fixup)
             return
-        
-        #Unknown token
-        unknown = self.consume_regex(r'\S+')
-        if unknown:
-            print(f"Unknown token: {unknown.group(0)}")
-        
-    #Look for labels and add index at output    
+        if self.verbose:
+            print(f"Resolving '{name}' at offset {offset} → {value:#04x}")
+        if (length, shift, mask) in ADDRESS_FIELDS:
+            self.check_address(value, offset, length, shift, mask)
+        elif (length, shift, mask) in DATA_FIELDS:
+            check_datum(value, offset, length)
+        patch_field(self.output, offset, length, shift, mask, value)
+
+    #Forward references are patched when their symbols are defined, anything left is undefined
+    def resolve_labels(self):
+        self.flush_strings()
+        for label in self.unresolved:
+            raise SyntaxError(f"Undefined label: {label}")
+        self.sections.check(self.current_addr, *self.areas())
+
+    #(start, end) of the default code and data areas
+    def areas(self) -> tuple:
+        code_end = self.current_addr if self.sections.current is None else self.sections.default_addr
+        data_start = self.mem_addr if self.data_start is None else self.data_start
+        return (0, code_end), (data_start, self.mem_addr)
+
+
+#Assembles a single line in isolation at the given code and data addresses, leaving every symbolic operand
+#for IncrementalAssembler to link, with offsets relative to those addresses
+class LineParser(AssemblyParser):
+
+    #Lines are cached whole by IncrementalAssembler
+    REPLAY = False
+
+    def __init__(self, text: bytes, macros: Optional[dict] = None, expansions: int = 0, file: Optional[str] = None,
+                 symbols: Optional[dict] = None, bases: tuple = (0, 0x8000), section: Optional[str] = None):
+        super().__init__()
+        self.verbose = False
+        self.current_input = text
+        self.file = file
+        if macros is not None:
+            self.macros = macros
+        self.expansions = expansions
+        #Constants of other lines, for directive arguments that must be known while parsing
+        self.symbols = symbols or {}
+        self.code_base, self.data_base = bases
+        self.current_addr, self.mem_addr = bases
+        self.fixups = []
+        self.data_fixups = []
+        self.constants = []
+        self.unknown = []
+        #Set by directives whose output depends on the absolute address
+        self.anchored = False
+        #Named section the line starts in, and the (name, origin) it switches to
+        self.sections.current = section
+        self.switch = None
+        #Macros and constants of other lines the line uses, which must be defined above it
+        self.needed = []
+        self.emitted = 0
+        #Whether each fixup, in source order, went to data_fixups rather than fixups
+        self.order = []
+
+    def operand(self, ast: tuple, length: int, shift: int, mask: int) -> int:
+        if type(ast) is int:
+            return ast
+        self.fixups.append((self.current_addr - self.code_base, length, shift, mask, ast, symbol_names(ast)))
+        self.order.append(False)
+        return 0
+
+    def datum(self, ast: tuple, addr: int, length: int) -> int:
+        if self.sections.current is not None:
+            self.fixups.append((addr - self.code_base, length, 0, (1 << 8 * length) - 1, ast, symbol_names(ast)))
+        else:
+            self.data_fixups.append((addr - self.data_base, length, 0, (1 << 8 * length) - 1, ast, symbol_names(ast)))
+        self.order.append(self.sections.current is None)
+        return 0
+
+    def constant(self, text: bytes, directive: str, pc: int) -> int:
+        ast = parse_expression(text)
+        value = evaluate(ast, self.symbols, pc)
+        if value is None:
+            raise SyntaxError(f"Undefined symbol in {directive} {text.decode().strip()}")
+        names = symbol_names(ast)
+        self.needed += [name for name in names if name in self.symbols]
+        if "$" in names:
+            self.anchored = True
+        return value
+
+    def invoke(self, m: re.Match):
+        self.needed.append(m.group(1).decode())
+        super().invoke(m)
+
+    def align(self, m: re.Match):
+        self.anchored = True
+        super().align(m)
+
+    def org(self, m: re.Match):
+        self.anchored = True
+        super().org(m)
+
+    #The incremental layout applies a section switch after the line, so nothing may follow it on the line
+    def switch_section(self, name: Optional[str], origin: Optional[int]):
+        self.switched()
+        self.switch = (name, origin)
+
+    def switched(self):
+        if self.switch is not None:
+            raise SyntaxError("Nothing may follow a section switch on its line")
+
+    def emit(self, op: int, length: int):
+        self.switched()
+        self.emitted += 1
+        super().emit(op, length)
+
+    def write_data(self, data):
+        self.switched()
+        super().write_data(data)
+
+    def define_label(self, label):
+        self.switched()
+        if label in self.labels:
+            raise SyntaxError(f"{label} is defined more than once")
+        self.labels[label] = self.current_addr - self.code_base
+
+    def define_constant(self, name, text: bytes):
+        self.constants.append((name, parse_expression(text), self.current_addr - self.code_base))
+
+    def unknown_token(self, m: re.Match):
+        self.unknown.append((m.start(), m.group(0).decode(errors='replace')))
+
+
+#Reassembles sources after an edit, re-encoding only changed lines and shifting everything after them
+class IncrementalAssembler:
+
+    #Includes are looked up next to file, named sections take their origin from the layout of name → (origin, size)
+    def __init__(self, file: Optional[str] = None, layout: Optional[dict] = None):
+        self.file = file
+        self.layout = layout or {}
+        self.output = bytearray(0x10000)
+        self.cache = {}
+        self.macros = {}
+        #Constants defined by .equ, known before any line is encoded
+        self.symbols = {}
+        self.definitions = ()
+        #Names of the macros and constants each definition adds
+        self.defined = ()
+        self.included = ()
+        self.clear()
+
+    #Forget the layout, so the next assembly encodes and places every line again
+    def clear(self):
+        self.output[:] = bytes(len(self.output))
+        self.texts = []
+        self.lines = []
+        self.code_addrs = [0]
+        self.data_addrs = [0x8000]
+        #Expansions before each line, which number the \@ labels of the macros it invokes
+        self.seeds = [0]
+        self.labels = {}
+        self.undefined = []
+        #Address fields out of range as (line, offset, value)
+        self.out_of_range = []
+        #Set while the sources use sections, whose lines are not laid out one after another
+        self.sectioned = False
+
+    #Split source into lines, keeping block comments and macro or repeat blocks that span several lines in one piece
+    def split_lines(self, source: bytes) -> list:
+        lines = source.splitlines(keepends=True)
+        if b"/*" not in source and b".macro" not in source and b".rept" not in source and b".irp" not in source:
+            return lines
+        units = []
+        pending = None
+        comment = False
+        depth = 0
+        for line in lines:
+            pending = line if pending is None else pending + line
+            if comment:
+                comment = b"*/" not in line
+            else:
+                start = line.rfind(b"/*")
+                comment = start >= 0 and line.find(b"*/", start) < 0
+                depth += len(BLOCK_OPEN.findall(line)) - len(BLOCK_CLOSE.findall(line))
+            if not comment and depth <= 0:
+                units.append(pending)
+                pending = None
+                depth = 0
+        if pending is not None:
+            units.append(pending)
+        return units
+
+    #Return (code, data, labels, fixups, unknown tokens, constants, expansions, data fixups, anchored, switch, needed)
+    #of a line relative to its own start, cached by line text and section, and by seed or address as well for lines that
+    #depend on them
+    def encode(self, text: bytes, seed: int, bases: tuple, section: Optional[str] = None) -> tuple:
+        key = text if section is None else (text, section)
+        line = self.cache.get(key)
+        if line is not None and (line[6] or line[8]):
+            line = self.cache.get((key, seed if line[6] else 0, bases if line[8] else None))
+        if line is None:
+            p = LineParser(text, self.macros, seed, self.file, self.symbols, bases, section)
+            p.parse_program()
+            line = (bytes(p.output[p.code_base:p.current_addr]), bytes(p.output[p.data_base:p.mem_addr]),
+                    tuple(p.labels.items()), tuple(p.fixups), tuple(p.unknown), tuple(p.constants),
+                    p.expansions - seed, tuple(p.data_fixups), p.anchored, p.switch, tuple(p.needed))
+            self.cache[key] = line
+            if line[6] or line[8]:
+                self.cache[(key, seed if line[6] else 0, bases if line[8] else None)] = line
+        return line
+
+    #True when none of the included files changed content
+    def fresh(self, dependencies: tuple) -> bool:
+        try:
+            return all(read_include(path)[0] == digest for path, digest in dependencies)
+        except SyntaxError:
+            return False
+
+    #Assemble the concatenated sources, reusing the layout of the unchanged lines around the edit
+    def assemble(self, sources: list) -> bytearray:
+        try:
+            sections = self.link(sources)
+        except Exception:
+            #The output is partly rewritten before the last steps that can fail, so what is left of the old layout
+            #no longer matches it
+            self.clear()
+            raise
+        if self.undefined:
+            raise SyntaxError(f"Undefined label: {self.undefined[0][2]}")
+        if self.out_of_range:
+            i, offset, value = self.out_of_range[0]
+            raise SyntaxError(f"Address {value:#06x} at {self.code_addrs[i] + offset:#06x} does not fit its field")
+        code_end = self.code_addrs[-1] if sections.current is None else sections.default_addr
+        sections.check(self.code_addrs[-1], (0, code_end), (self.data_addrs[0], self.data_addrs[-1]))
+        return self.output
+
+    #Lay out and patch the lines of the sources and keep the result, return the section counters after the last line
+    def link(self, sources: list) -> Sections:
+        texts = []
+        definitions = []
+        positions = []
+        for source in sources:
+            units = self.split_lines(source)
+            #Lines defining macros or constants, or including files, found by offset in the source
+            ends = list(itertools.accumulate(map(len, units)))
+            for i in dict.fromkeys(bisect.bisect_right(ends, m.start()) for m in DEFINITION.finditer(source)):
+                definitions.append(units[i])
+                positions.append(len(texts) + i)
+            texts += units
+        definitions = tuple(definitions)
+        old_texts = self.texts
+        limit = min(len(texts), len(old_texts))
+        start = 0
+        end = 0
+        #Any line may invoke a macro or use a constant, so changing a definition or an included file re-encodes everything
+        if definitions != self.definitions or not self.fresh(self.included):
+            #Until the definitions are read without error
+            self.definitions = None
+            self.macros = {}
+            self.symbols = {}
+            included = {}
+            defined = []
+            for t in definitions:
+                p = LineParser(t, self.macros, 0, self.file, self.symbols)
+                macros, symbols = len(self.macros), len(self.symbols)
+                p.parse_program()
+                included.update(p.dependencies)
+                for name, ast, _ in p.constants:
+                    if (value := evaluate(ast, self.symbols, 0)) is not None:
+                        self.symbols[name] = value
+                defined.append(tuple(name.decode() for name in itertools.islice(self.macros, macros, None))
+                               + tuple(itertools.islice(self.symbols, symbols, None)))
+            self.included = tuple(included.items())
+            self.defined = tuple(defined)
+            self.cache = {}
+            limit = 0
+        #Section switches jump between areas, so lines after an edit are laid out again rather than shifted
+        sectioned = any(b".section" in text or b".text" in text for text in itertools.chain(
+            sources, (read_include(path)[1] for path, _ in self.included)))
+        if sectioned or self.sectioned:
+            limit = 0
+        while start < limit and texts[start] == old_texts[start]:
+            start += 1
+        while end < limit - start and texts[-1 - end] == old_texts[-1 - end]:
+            end += 1
+        old_stop = len(old_texts) - end
+        stop = len(texts) - end
+
+        #Encode the changed lines and lay them out after the unchanged prefix
+        middle = []
+        code_addrs = self.code_addrs[:start + 1]
+        data_addrs = self.data_addrs[:start + 1]
+        seeds = self.seeds[:start + 1]
+        sections = Sections()
+        sections.layout = self.layout
+        i = start
+        while True:
+            for t in texts[i:stop]:
+                line = self.encode(t, seeds[-1], (code_addrs[-1], data_addrs[-1]), sections.current)
+                middle.append(line)
+                addr = code_addrs[-1] + len(line[0])
+                code_addrs.append(addr if line[9] is None else sections.switch(*line[9], addr))
+                data_addrs.append(data_addrs[-1] + len(line[1]))
+                seeds.append(seeds[-1] + line[6])
+            code_delta = code_addrs[-1] - self.code_addrs[old_stop]
+            data_delta = data_addrs[-1] - self.data_addrs[old_stop]
+            #Aligned or .org lines after the edit depend on where they land, re-encode up to the next one that moved
+            if not code_delta and not data_delta:
+                break
+            anchor = next((j for j in range(old_stop, len(old_texts)) if self.lines[j][8]), None)
+            if anchor is None:
+                break
+            i = stop
+            stop += anchor + 1 - old_stop
+            old_stop = anchor + 1
+
+        #Shift the unchanged suffix by how much the middle grew or shrank
+        code_addrs += [a + code_delta for a in self.code_addrs[old_stop + 1:]]
+        data_addrs += [a + data_delta for a in self.data_addrs[old_stop + 1:]]
+        if code_addrs[-1] > 0x10000 or data_addrs[-1] > 0x10000:
+            raise SyntaxError("Program does not fit in memory")
+        #Every line sees all macros and directive constants, uses above the definition would not assemble in one pass
+        defined_at = {}
+        for i, names in zip(positions, self.defined):
+            for name in names:
+                defined_at.setdefault(name, i)
+        if defined_at:
+            for i, line in enumerate(itertools.chain(self.lines[:start], middle, self.lines[old_stop:])):
+                for name in line[10]:
+                    if defined_at.get(name, -1) > i:
+                        raise SyntaxError(f"{name} is used before its definition")
+        code_tail = bytes(self.output[self.code_addrs[old_stop]:self.code_addrs[-1]])
+        data_tail = bytes(self.output[self.data_addrs[old_stop]:self.data_addrs[-1]])
+        if sectioned or self.sectioned:
+            self.output[:] = bytes(len(self.output))
+        for i, line in enumerate(middle, start):
+            self.output[code_addrs[i]:code_addrs[i] + len(line[0])] = line[0]
+            self.output[data_addrs[i]:data_addrs[i + 1]] = line[1]
+        self.output[code_addrs[stop]:code_addrs[-1]] = code_tail
+        self.output[data_addrs[stop]:data_addrs[-1]] = data_tail
+        #Clear whatever the old layout left past the new end
+        if code_addrs[-1] < self.code_addrs[-1]:
+            self.output[code_addrs[-1]:self.code_addrs[-1]] = bytes(self.code_addrs[-1] - code_addrs[-1])
+        if data_addrs[-1] < self.data_addrs[-1]:
+            self.output[data_addrs[-1]:self.data_addrs[-1]] = bytes(self.data_addrs[-1] - data_addrs[-1])
+
+        lines = self.lines[:start] + middle + self.lines[old_stop:]
+        #Unchanged lines expanding macros after the edit keep their bytes but renumber their \@ labels
+        seed_delta = seeds[-1] - self.seeds[old_stop]
+        seeds += [a + seed_delta for a in self.seeds[old_stop + 1:]]
+        renumbered = set()
+        if seed_delta:
+            for i in range(stop, len(lines)):
+                if lines[i][6]:
+                    lines[i] = self.encode(texts[i], seeds[i], (code_addrs[i], data_addrs[i]))
+                    renumbered.add(i)
+        labels = {}
+        for line, addr in zip(lines, code_addrs):
+            for label, offset in line[2]:
+                if label in labels:
+                    raise SyntaxError(f"{label} is defined more than once")
+                labels[label] = addr + offset
+        #Constants are evaluated in source order once every label address is known
+        undefined = []
+        for i, line in enumerate(lines):
+            for name, ast, offset in line[5]:
+                value = evaluate(ast, labels, code_addrs[i] + offset)
+                if value is None:
+                    undefined += [(i, offset, n) for n in symbol_names(ast) if n != "$" and n not in labels]
+                elif name in labels:
+                    raise SyntaxError(f"{name} is defined more than once")
+                else:
+                    labels[name] = value
+
+        #Patch fixups in re-encoded lines, fixups whose symbols moved and $ in lines that moved
+        old_labels = self.labels
+        out_of_range = []
+        patched = set()
+        for i, line in enumerate(lines):
+            if not line[3] and not line[7]:
+                continue
+            changed = start <= i < stop or i in renumbered
+            for fixups, addr, delta in ((line[3], code_addrs[i], code_delta), (line[7], data_addrs[i], data_delta)):
+                moved = i >= stop and delta != 0
+                for offset, length, shift, mask, ast, names in fixups:
+                    missing = [n for n in names if n != "$" and n not in labels]
+                    if missing:
+                        undefined += [(i, offset, n) for n in missing]
+                        continue
+                    if changed or any(labels[n] != old_labels.get(n) for n in names if n != "$") or (moved and "$" in names):
+                        value = evaluate(ast, labels, addr + offset)
+                        if (length, shift, mask) in ADDRESS_FIELDS:
+                            patched.add((i, offset))
+                            if not 0 <= value <= mask:
+                                out_of_range.append((i, offset, value))
+                        elif (length, shift, mask) in DATA_FIELDS:
+                            check_datum(value, addr + offset, length)
+                        patch_field(self.output, addr + offset, length, shift, mask, value)
+        #Addresses out of range stay reported until their fixup is patched again
+        for i, offset, value in self.out_of_range:
+            if start <= i < old_stop:
+                continue
+            if i >= old_stop:
+                i += stop - old_stop
+            if (i, offset) not in patched:
+                out_of_range.append((i, offset, value))
+
+        self.texts = texts
+        self.definitions = definitions
+        self.lines = lines
+        self.code_addrs = code_addrs
+        self.data_addrs = data_addrs
+        self.seeds = seeds
+        self.labels = labels
+        self.undefined = undefined
+        self.out_of_range = out_of_range
+        self.sectioned = sectioned
+        return sections
+
+
+#Assembler that times each phase and counts what it emits, for --time-report and --mem-report
+class ReportingParser(AssemblyParser):
+
+    PHASES = ("read", "parse", "resolve", "write")
+
+    def __init__(self, mem_report: bool = False):
+        super().__init__()
+        self.mem_report = mem_report
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.peaks = dict.fromkeys(self.PHASES, 0)
+        self.instructions = 0
+        self.fixups = 0
+        if mem_report:
+            #Imported here so startup of the default command line does not pay for it
+            import tracemalloc
+            tracemalloc.start()
+            self.tracemalloc = tracemalloc
+
+    #Run one phase, adding its wall time and peak traced memory to the totals
+    def phase(self, name: str, fn, *args):
+        if self.mem_report:
+            self.tracemalloc.reset_peak()
+        start = time.perf_counter()
+        fn(*args)
+        self.times[name] += time.perf_counter() - start
+        if self.mem_report:
+            self.peaks[name] = max(self.peaks[name], self.tracemalloc.get_traced_memory()[1])
+
+    def parse_file(self, file: str, outFile: str):
+        with open(file, "rb") as i:
+            self.phase("read", self.read_file, i)
+            self.phase("parse", self.parse_program)
+            self.close_file()
+        self.phase("resolve", self.resolve_labels)
+        self.phase("write", self.write_file, outFile)
+
+    def emit(self, op: int, length: int):
+        self.instructions += 1
+        super().emit(op, length)
+
+    def defer(self, fixup: tuple):
+        self.fixups += 1
+        super().defer(fixup)
+
+    def replay(self, replay: tuple):
+        super().replay(replay)
+        self.instructions += replay[3]
+
+    #Print phase table in the style of gcc -ftime-report
+    def report(self, time_report: bool):
+        total = sum(self.times.values())
+        print("Phase        " + ("    wall (s)      %" if time_report else "") + ("   peak mem (KiB)" if self.mem_report else ""))
+        for name in self.PHASES:
+            line = f" {name:<12}"
+            if time_report:
+                line += f"{self.times[name]:12.6f} {self.times[name] / total * 100 if total else 0:6.1f}"
+            if self.mem_report:
+                line += f"{self.peaks[name] / 1024:17.1f}"
+            print(line)
+        if time_report:
+            print(f" {'TOTAL':<12}{total:12.6f}")
+        print(f"Instructions: {self.instructions}  Labels: {len(self.labels)}  Fixups: {self.fixups}  "
+              f"Bytes emitted: {sum(end - start for _, start, end in self.sections.segments(self.current_addr, *self.areas()))}")
+
+
+#Assembler that widens LD and ST whose address does not fit 14 bits into a register pair sequence, for --relax
+#
+#    LD Rd, addr   →   LDI Rh, hi(addr)   LDI Rl, lo(addr)   LDIRP Rd, (Rhl)
+#    ST Rs, addr   →   LDI Rh, hi(addr)   LDI Rl, lo(addr)   STIRP (Rhl), Rs
+#
+#The pair is R23 for R0 and R1, R01 otherwise, and is clobbered. Widening an instruction moves everything after it in
+#its section, so only the LD and ST depending on a symbol that moved are checked again until none has to grow.
+class RelaxingParser(AssemblyParser):
+
+    #Bytes a widened LD or ST adds
+    GROWTH = 5
+    #Every reference is recorded as it is parsed
+    REPLAY = False
+
+    def __init__(self):
+        super().__init__()
+        #Symbolic operands and data as (area, sequence, offset, length, shift, mask, ast), patched again once relaxed
+        self.references = []
+        #Labels as name → (area, sequence, address)
+        self.positions = {}
+        #.equ in definition order as (name, area, sequence, pc, ast)
+        self.constants = []
+        #.align and .org in named sections as (area, sequence, address, padding, boundary or None, fill)
+        self.anchors = []
+        #Orders what is recorded at the same address
+        self.sequence = 0
+
+    #Code area of the current address, .text for the default layout
+    def area(self) -> str:
+        return self.sections.current or ".text"
+
+    def record(self, area: str, offset: int, length: int, shift: int, mask: int, ast):
+        self.sequence += 1
+        self.references.append((area, self.sequence, offset, length, shift, mask, ast))
+
+    def operand(self, ast, length: int, shift: int, mask: int) -> int:
+        if type(ast) is not int:
+            self.record(self.area(), self.current_addr, length, shift, mask, ast)
+        return super().operand(ast, length, shift, mask)
+
+    #Literal addresses out of range are recorded too, relax() finds them with the symbolic ones
+    def address(self, ast, value: int, length: int, shift: int, mask: int) -> int:
+        if type(ast) is int and (length, shift, mask) == RELAXABLE:
+            self.record(self.area(), self.current_addr, length, shift, mask, ast)
+        return super().address(ast, value, length, shift, mask)
+
+    #LD and ST out of range are widened instead of rejected
+    def check_address(self, value: int, offset: int, length: int, shift: int, mask: int):
+        if (length, shift, mask) != RELAXABLE:
+            super().check_address(value, offset, length, shift, mask)
+
+    def datum(self, ast, addr: int, length: int) -> int:
+        self.record(self.sections.current or ".data", addr, length, 0, (1 << 8 * length) - 1, ast)
+        return super().datum(ast, addr, length)
+
+    def define_label(self, label):
+        self.sequence += 1
+        self.positions[label] = (self.area(), self.sequence, self.current_addr)
+        super().define_label(label)
+
+    def define_constant(self, name, text: bytes):
+        self.sequence += 1
+        self.constants.append((name, self.area(), self.sequence, self.current_addr, parse_expression(text)))
+        super().define_constant(name, text)
+
+    #Pooled strings move with the code before them like labels do
+    def flush_strings(self):
+        labels = [label for _, names in self.strings for label in names]
+        area = self.sections.current or ".data"
+        super().flush_strings()
+        for label in labels:
+            self.sequence += 1
+            self.positions[label] = (area, self.sequence, self.labels[label])
+
+    def align(self, m: re.Match):
+        self.anchor(m, super().align, True)
+
+    def org(self, m: re.Match):
+        self.anchor(m, super().org, False)
+
+    #Padding of .align and .org in a named section changes when code before it grows
+    def anchor(self, m: re.Match, directive, align: bool):
+        addr = self.current_addr
+        directive(m)
+        if self.sections.current is not None:
+            args = split_arguments(m.group(1))
+            boundary = self.constant(args[0], ".align", addr) if align else None
+            fill = self.constant(args[1], ".align", addr) & 0xFF if align and len(args) > 1 else 0
+            self.sequence += 1
+            self.anchors.append((self.sections.current, self.sequence, addr, self.current_addr - addr, boundary, fill))
+
     def resolve_labels(self):
-        for label, offset in self.unresolved:
-            if label not in self.labels:
-                raise SyntaxError(f"Undefined label: {label}")
-            addr = self.labels[label]
-            print(f"Resolving BR to '{label}' at offset {offset} → {addr:#04x}")
-            self.output[offset + 1] = (addr >> 8) & 0xFF
-            self.output[offset + 2] = addr & 0xFF
-
-#Take in arguments from command line
-parser = argparse.ArgumentParser()
-parser.add_argument("inputs",metavar="INPUT",nargs="*",help="input files to assemble")
-parser.add_argument("-o", "--output", default="out.bin", help="output binary file")
-args = parser.parse_args()
-
-#Parse file
-parser = AssemblyParser()
-for i in args.inputs:
-    parser.parse_file(i,args.output)
\ No newline at end of file
+        self.flush_strings()
+        if not self.unresolved:
+            self.relax()
+        super().resolve_labels()
+
+    #(keys, shifts) of an area, the shift of everything after each widened instruction or padding, by (address, sequence)
+    def shifts(self, events: list) -> tuple:
+        events.sort()
+        keys = []
+        shifts = []
+        shift = 0
+        for addr, sequence, anchor in events:
+            if anchor is None:
+                shift += self.GROWTH
+            else:
+                padding, boundary, _ = anchor
+                start = addr + shift
+                new = -start % boundary if boundary else addr + padding - start
+                if new < 0:
+                    raise SyntaxError(f"Relaxed code runs past .org {addr + padding:#06x}")
+                shift += new - padding
+            keys.append((addr, sequence))
+            shifts.append(shift)
+        return keys, shifts
+
+    #Address after relaxation of what was recorded at addr
+    def moved(self, layouts: dict, area: str, addr: int, sequence: int) -> int:
+        layout = layouts.get(area)
+        if layout is None:
+            return addr
+        keys, shifts = layout
+        i = bisect.bisect_left(keys, (addr, sequence))
+        return addr + shifts[i - 1] if i else addr
+
+    #(start, end) of an area
+    def extent(self, area: str) -> tuple:
+        if area == ".text":
+            return 0, self.current_addr if self.sections.current is None else self.sections.default_addr
+        origin, end = self.sections.counters[area]
+        return origin, self.current_addr if area == self.sections.current else end
+
+    def set_end(self, area: str, end: int):
+        if area == (self.sections.current or ".text"):
+            self.current_addr = end
+        elif area == ".text":
+            self.sections.default_addr = end
+        else:
+            self.sections.counters[area][1] = end
+
+    #Widen LD and ST until every address fits, then lay out the areas that grew and patch every reference again
+    def relax(self):
+        candidates = [r for r in self.references if r[3:6] == RELAXABLE]
+        dependents = {}
+        for i, candidate in enumerate(candidates):
+            for name in symbol_names(candidate[6]):
+                dependents.setdefault(name, []).append(i)
+        events = {}
+        for area, sequence, addr, padding, boundary, fill in self.anchors:
+            events.setdefault(area, []).append((addr, sequence, (padding, boundary, fill)))
+        layouts = {}
+        widened = {}
+        labels = dict(self.labels)
+        work = range(len(candidates))
+        while work:
+            grow = []
+            for i in work:
+                area, sequence, offset, _, _, mask, ast = candidates[i]
+                if (area, sequence) not in widened and not 0 <= evaluate(ast, labels, self.moved(layouts, area, offset, sequence)) <= mask:
+                    grow.append(i)
+            if not grow:
+                break
+            touched = set()
+            for i in grow:
+                area, sequence, offset = candidates[i][:3]
+                #Opcode and register of the instruction as parsed
+                widened[(area, sequence)] = (self.output[offset], self.output[offset + 1] >> 6)
+                events.setdefault(area, []).append((offset, sequence, None))
+                touched.add(area)
+            for area in touched:
+                layouts[area] = self.shifts(events[area])
+            #Labels after a widened instruction move, and so do constants computed from them
+            changed = set()
+            for name, (area, sequence, addr) in self.positions.items():
+                if area in touched and labels.get(name) != (value := self.moved(layouts, area, addr, sequence)):
+                    labels[name] = value
+                    changed.add(name)
+            for name, area, sequence, pc, ast in self.constants:
+                if labels.get(name) != (value := evaluate(ast, labels, self.moved(layouts, area, pc, sequence))):
+                    labels[name] = value
+                    changed.add(name)
+            work = {i for name in changed for i in dependents.get(name, ())}
+            work.update(i for i in dependents.get("$", ()) if candidates[i][0] in touched)
+        if not widened:
+            return
+
+        for area in layouts:
+            start, end = self.extent(area)
+            data = bytearray()
+            prev = start
+            before = 0
+            for (addr, _, anchor), shift in zip(events[area], layouts[area][1]):
+                data += self.output[prev:addr]
+                if anchor is None:
+                    data += bytes(self.GROWTH + 3)
+                    prev = addr + 3
+                else:
+                    padding, _, fill = anchor
+                    data += bytes([fill]) * (padding + shift - before)
+                    prev = addr + padding
+                before = shift
+            data += self.output[prev:end]
+            if start + len(data) > len(self.output):
+                raise SyntaxError("Program does not fit in memory")
+            self.output[start:end] = bytes(end - start)
+            self.output[start:start + len(data)] = data
+            self.set_end(area, start + len(data))
+
+        for area, sequence, offset, length, shift, mask, ast in self.references:
+            pc = self.moved(layouts, area, offset, sequence)
+            value = evaluate(ast, labels, pc)
+            if (area, sequence) in widened:
+                opcode, reg = widened[(area, sequence)]
+                self.output[pc:pc + self.GROWTH + 3] = self.widen(opcode, reg, value)
+                if self.verbose:
+                    print(f"Relaxed {'LD' if opcode == INSTRUCTIONS['LD'][1] else 'ST'} R{reg} at {pc:#06x} for address {value:#06x}")
+                continue
+            if (length, shift, mask) in ADDRESS_FIELDS:
+                self.check_address(value, pc, length, shift, mask)
+            elif (length, shift, mask) in DATA_FIELDS:
+                check_datum(value, pc, length)
+            patch_field(self.output, pc, length, shift, mask, value)
+        self.labels = labels
+
+    #LD or ST of reg through the pair not holding it, the first register of a pair holds the high byte
+    def widen(self, opcode: int, reg: int, value: int) -> bytes:
+        if not 0 <= value <= 0xFFFF:
+            raise SyntaxError(f"Address {value:#06x} does not fit a register pair")
+        pair = 1 if reg < 2 else 0
+        code = encode_instruction("LDI", 2 * pair, value >> 8) + encode_instruction("LDI", 2 * pair + 1, value & 0xFF)
+        if opcode == INSTRUCTIONS["LD"][1]:
+            return code + encode_instruction("LDIRP", reg, pair)
+        return code + encode_instruction("STIRP", pair, reg)
+
+
+#Modification time of path, None while it is missing, as when an editor replaces the file on save
+def mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+#Rebuild the output whenever one of the inputs is saved
+def watch(inputs: list, outFile: str, interval: float, layout: Optional[dict] = None):
+    assembler = IncrementalAssembler(inputs[0] if inputs else None, layout)
+    mtimes = None
+    while True:
+        #Files pulled in with .include or .incbin are polled along with the inputs
+        paths = dict.fromkeys(inputs + [path for path, _ in assembler.included])
+        current = {path: mtime(path) for path in paths}
+        if current != mtimes:
+            start = time.perf_counter()
+            try:
+                sources = []
+                for i in inputs:
+                    with open(i, "rb") as f:
+                        sources.append(f.read())
+                output = assembler.assemble(sources)
+            except OSError as e:
+                print(f"Error: cannot read {e.filename}: {e.strerror}")
+            except SyntaxError as e:
+                print(f"Error: {e}")
+            else:
+                with open(outFile, "wb") as f:
+                    f.write(output)
+                print(f"Rebuilt {outFile} in {(time.perf_counter() - start) * 1000:.1f} ms")
+            #Files included for the first time are polled from the version the build read
+            mtimes = {path: current[path] if path in current else INCLUDES[path][0] if path in INCLUDES else None
+                      for path in dict.fromkeys(inputs + [path for path, _ in assembler.included])}
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    #Take in arguments from command line
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs",metavar="INPUT",nargs="*",help="input files to assemble")
+    parser.add_argument("-o", "--output", default="out.bin", help="output binary file")
+    parser.add_argument("-m", "--map", help="write label addresses to a symbol map file")
+    parser.add_argument("-MD", dest="dependencies", action="store_true", help="write a make rule for the output to OUTPUT.d")
+    parser.add_argument("-T", "--layout", help="memory layout of \"name origin size\" lines giving section origins and limits")
+    parser.add_argument("-w", "--watch", action="store_true", help="rebuild incrementally whenever an input changes")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between checks in watch mode")
+    parser.add_argument("--relax", action="store_true", help="widen LD and ST beyond 14-bit addresses through a register pair")
+    parser.add_argument("--pool-strings", action="store_true", help="store equal .ascii strings and string tails once, "
+                        "a label right before an .ascii then holds the address of the pooled string")
+    parser.add_argument("--time-report", action="store_true", help="print wall time spent in each phase")
+    parser.add_argument("--mem-report", action="store_true", help="print peak memory of each phase")
+    args = parser.parse_args()
+    if args.relax and (args.watch or args.time_report or args.mem_report):
+        parser.error("--relax cannot be combined with --watch, --time-report or --mem-report")
+    if args.pool_strings and args.watch:
+        parser.error("--pool-strings cannot be combined with --watch")
+
+    sections = Sections()
+    if args.layout:
+        sections.read_layout(args.layout)
+
+    #Parse file
+    if args.watch:
+        try:
+            watch(args.inputs, args.output, args.interval, sections.layout)
+        except KeyboardInterrupt:
+            pass
+    elif args.time_report or args.mem_report:
+        parser = ReportingParser(args.mem_report)
+        parser.sections = sections
+        parser.pooling = args.pool_strings
+        for i in args.inputs:
+            parser.parse_file(i,args.output)
+        parser.report(args.time_report)
+    else:
+        parser = RelaxingParser() if args.relax else AssemblyParser()
+        parser.sections = sections
+        parser.pooling = args.pool_strings
+        for i in args.inputs:
+            parser.parse_file(i,args.output)
+    if args.map and not args.watch:
+        parser.write_map(args.map)
+    if args.dependencies and not args.watch:
+        parser.write_dependencies(args.output, os.path.splitext(args.output)[0] + ".d")
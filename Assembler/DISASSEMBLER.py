@@ -0,0 +1,212 @@
+import argparse
+import itertools
+from typing import Optional
+
+from ASSEMBLER import ISA, AssemblyParser, encode_instruction
+
+
+#Instructions that never continue to the next address
+STOPS = {"JMP", "HLT", "RET"}
+
+#Start of the data area written by .ascii
+DATA = 0x8000
+
+
+#Return a function extracting the operand values of an instruction word
+def extractor(fields: tuple):
+    specs = tuple((shift, (1 << width) - 1) for _, shift, width in fields)
+    return lambda word: tuple((word >> shift) & mask for shift, mask in specs)
+
+
+#Decode table indexed by opcode: (mnemonic, length, syntax, operand kinds, extractor) or None
+DECODE = [None] * 256
+for mnemonic, opcode, length, syntax, fields in ISA:
+    DECODE[opcode] = (mnemonic, length, syntax, tuple(kind for kind, _, _ in fields), extractor(fields))
+
+
+#Read a map file of "address name" lines written by the assembler
+def read_map(mapFile: str) -> dict:
+    symbols = {}
+    with open(mapFile) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                symbols.setdefault(int(parts[0], 16), parts[1])
+    return symbols
+
+
+class Disassembler:
+
+    #Constructor takes the assembled image and optional address to name symbols
+    def __init__(self, image: bytes, symbols: Optional[dict] = None):
+        self.image = bytes(image).ljust(0x10000, b"\0")
+        self.symbols = dict(symbols or {})
+        self.instructions = {}
+        self.targets = set()
+
+    #Return the decoded instruction at addr, or None when it is not a valid encoding
+    def decode(self, addr: int) -> Optional[tuple]:
+        entry = DECODE[self.image[addr]]
+        if entry is None or addr + entry[1] > DATA:
+            return None
+        mnemonic, length, syntax, kinds, extract = entry
+        word = int.from_bytes(self.image[addr:addr + length], 'big')
+        return mnemonic, length, syntax, kinds, extract(word)
+
+    #Follow control flow from the entry points, separating reachable code from everything else
+    def traverse(self, entries: list):
+        work = list(entries)
+        while work:
+            addr = work.pop()
+            while 0 <= addr < DATA and addr not in self.instructions:
+                decoded = self.decode(addr)
+                if decoded is None:
+                    break
+                self.instructions[addr] = decoded
+                mnemonic, length, _, kinds, values = decoded
+                for kind, value in zip(kinds, values):
+                    if kind == "label":
+                        self.targets.add(value)
+                        work.append(value)
+                if mnemonic in STOPS:
+                    break
+                addr += length
+
+    def name(self, addr: int) -> str:
+        if addr not in self.symbols:
+            self.symbols[addr] = f"L_{addr:04x}"
+        return self.symbols[addr]
+
+    def format(self, decoded: tuple) -> str:
+        mnemonic, _, syntax, kinds, values = decoded
+        operands = []
+        for kind, value in zip(kinds, values):
+            if kind == "reg":
+                operands.append(str(value))
+            elif kind == "pair":
+                operands.append("23" if value else "01")
+            elif kind == "label" and value < DATA:
+                operands.append(self.name(value))
+            elif kind == "imm" and value <= 0xFF:
+                operands.append(f"0x{value:02X}")
+            else:
+                operands.append(f"0x{value:04X}")
+        return f"{mnemonic} {syntax.format(*operands)}" if syntax else mnemonic
+
+    #Return the data area as .ascii directives, up to its last non-zero byte
+    def data(self) -> list:
+        data = self.image[DATA:].rstrip(b"\0")
+        if not data:
+            return []
+        text = ""
+        for byte in data:
+            if byte == 0x0A:
+                text += "\\n"
+            elif byte == 0x09:
+                text += "\\t"
+            elif byte in (0x22, 0x5C):
+                text += "\\" + chr(byte)
+            elif 0x20 <= byte < 0x7F:
+                text += chr(byte)
+            else:
+                text += f"\\x{byte:02x}"
+        return [f'.ascii "{text}"']
+
+    #Return (listing, end, raw) of the code area as (address, line) pairs up to end, or past it up to the last label,
+    #raw is set when some bytes had to be written as .byte
+    def code(self, end: int) -> tuple:
+        listing = []
+        addr = 0
+        raw = False
+        while True:
+            while addr < end:
+                decoded = self.instructions.get(addr)
+                comment = ""
+                if decoded is None:
+                    #Bytes not reached from any entry point, decoded linearly where possible
+                    decoded = self.decode(addr)
+                    comment = " # unreached"
+                #An instruction running over the start of another one or over a label cannot be written as source,
+                #nor can one with bits set outside its fields, which reassemble as zeros
+                reason = "invalid opcode"
+                if decoded is not None:
+                    if any(a in self.instructions or a in self.symbols for a in range(addr + 1, addr + decoded[1])):
+                        decoded, reason = None, "overlaps an instruction or label"
+                    elif encode_instruction(decoded[0], *decoded[4]) != self.image[addr:addr + decoded[1]]:
+                        decoded, reason = None, "bits set outside the operand fields"
+                if decoded is None:
+                    #Only inside a named section does .byte land at the address it appears at
+                    listing.append((addr, f"    .byte {self.image[addr]:#04x} # {addr:#06x}: {reason}"))
+                    raw = True
+                    addr += 1
+                    continue
+                listing.append((addr, f"    {self.format(decoded)}{comment}"))
+                addr += decoded[1]
+            #A label may lie past the last non-zero byte, like the end of a program whose last instruction ends in zeros
+            end = max((a for a in itertools.chain(self.targets, self.symbols) if a < DATA), default=0)
+            if end <= addr:
+                return listing, addr, raw
+
+    #Return the source text of the whole image
+    def disassemble(self, entries: list = (0,)) -> str:
+        self.traverse(entries)
+        end = max((addr + decoded[1] for addr, decoded in self.instructions.items()), default=0)
+        end = max(end, len(self.image[:DATA].rstrip(b"\0")))
+        for target in self.targets:
+            self.name(target)
+        #Lay out the code area first so targets of unreached code are named before labels are placed, again while that
+        #names new targets, which may lie inside an instruction listed before them
+        while True:
+            named = len(self.symbols)
+            listing, end, raw = self.code(end)
+            if len(self.symbols) == named:
+                break
+
+        lines = self.data()
+        if raw:
+            lines.append(".section code, 0x0000")
+        for addr, line in listing:
+            if addr in self.symbols:
+                lines.append(f"{self.symbols[addr]}:")
+            lines.append(line)
+        if end in self.symbols:
+            lines.append(f"{self.symbols[end]}:")
+        return "\n".join(lines) + "\n"
+
+
+#Assemble source again and return the first address whose byte differs from image, or None
+def verify(source: str, image: bytes) -> Optional[int]:
+    p = AssemblyParser()
+    p.verbose = False
+    p.current_input = source.encode()
+    p.parse_program()
+    p.resolve_labels()
+    image = bytes(image).ljust(0x10000, b"\0")
+    if p.output == image:
+        return None
+    return next(addr for addr in range(0x10000) if p.output[addr] != image[addr])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT", help="assembled image to disassemble")
+    parser.add_argument("-o", "--output", help="write source to file instead of stdout")
+    parser.add_argument("-m", "--map", help="symbol map file written by the assembler")
+    parser.add_argument("-e", "--entry", type=lambda x: int(x, 0), action="append", help="additional entry point address")
+    parser.add_argument("--verify", action="store_true", help="reassemble the output and compare it with the image")
+    args = parser.parse_args()
+
+    with open(args.input, "rb") as f:
+        image = f.read()
+    symbols = read_map(args.map) if args.map else {}
+    source = Disassembler(image, symbols).disassemble([0] + (args.entry or []))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(source)
+    else:
+        print(source, end="")
+    if args.verify:
+        mismatch = verify(source, image)
+        if mismatch is not None:
+            raise SystemExit(f"Reassembled image differs at {mismatch:#06x}")
+        print("# Reassembled image matches")
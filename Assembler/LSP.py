@@ -0,0 +1,309 @@
+import json
+import re
+import sys
+from bisect import bisect_right
+from typing import Optional
+from urllib.parse import unquote, urlparse
+
+from ASSEMBLER import IncrementalAssembler
+
+
+#Language server speaking LSP over stdio, backed by an incrementally assembled symbol index
+#
+#    textDocument/definition     Location of the label or .equ constant under the cursor
+#    textDocument/references     Every branch referencing the label under the cursor
+#    textDocument/hover          Address and encoded bytes of the line, or address of the label
+#    publishDiagnostics          Undefined labels and unknown tokens
+
+
+WORD = re.compile(rb'[A-Za-z_]\w*')
+EQU = re.compile(rb'\.equ\s+$')
+
+
+class Document:
+
+    #Constructor assembles the initial text and builds the index, includes are looked up next to file
+    def __init__(self, text: str, file: Optional[str] = None):
+        self.text = text
+        self.assembler = IncrementalAssembler(file)
+        self.symbols = {}
+        self.starts = []
+        self.definitions = {}
+        self.references = {}
+        self.diagnostics = []
+        #Message of the error that stopped the last assembly, None when it produced an image
+        self.error = None
+        self.update()
+
+    #Apply LSP content changes, ranged edits are spliced into the current text
+    def change(self, changes: list):
+        for change in changes:
+            if "range" not in change:
+                self.text = change["text"]
+                continue
+            start = self.offset(change["range"]["start"])
+            end = self.offset(change["range"]["end"])
+            self.text = self.text[:start] + change["text"] + self.text[end:]
+        self.update()
+
+    #Convert a line/character position into an offset in the text
+    def offset(self, position: dict) -> int:
+        offset = 0
+        for _ in range(position["line"]):
+            offset = self.text.index("\n", offset) + 1
+        end = self.text.find("\n", offset)
+        return offset + code_points(self.text[offset:end if end >= 0 else len(self.text)], position["character"])
+
+    #Return (definitions, references) of a line as (label, column) pairs, cached by line text
+    def scan(self, text: bytes, line: tuple) -> tuple:
+        if (symbols := self.symbols.get(text)) is None:
+            defined = {label for label, _ in line[2]}
+            constants = {name for name, _, _ in line[5]}
+            referenced = {name for fixup in line[3] + line[7] for name in fixup[5]}
+            definitions = []
+            references = []
+            for m in WORD.finditer(text):
+                label = m.group(0).decode()
+                if label in defined and text[m.end():m.end() + 1] == b":":
+                    definitions.append((label, m.start()))
+                elif label in constants and EQU.search(text, 0, m.start()):
+                    definitions.append((label, m.start()))
+                elif label in referenced:
+                    references.append((label, m.start()))
+            symbols = (tuple(definitions), tuple(references))
+            self.symbols[text] = symbols
+        return symbols
+
+    #Reassemble changed lines and rebuild the label index from the cached per-line results
+    def update(self):
+        assembler = self.assembler
+        self.error = None
+        try:
+            assembler.assemble([self.text.encode()])
+        except SyntaxError as e:
+            self.error = str(e)
+            if not assembler.undefined and not assembler.out_of_range:
+                self.diagnostics = [diagnostic(0, 0, 0, str(e))]
+                return
+        self.starts = []
+        self.definitions = {}
+        self.references = {}
+        self.diagnostics = []
+        undefined = {label for _, _, label in assembler.undefined}
+        number = 0
+        for text, line in zip(assembler.texts, assembler.lines):
+            self.starts.append(number)
+            definitions, references = self.scan(text, line)
+            for label, column in definitions:
+                self.definitions[label] = position(text, number, column)
+            for label, column in references:
+                self.references.setdefault(label, []).append(position(text, number, column))
+                if label in undefined:
+                    line_number, character = position(text, number, column)
+                    self.diagnostics.append(diagnostic(line_number, character, len(label), f"Undefined label: {label}"))
+            for column, token in line[4]:
+                line_number, character = position(text, number, column)
+                self.diagnostics.append(diagnostic(line_number, character, utf16_length(token), f"Unknown token: {token}"))
+            number += text.count(b"\n")
+        for i, _, value in assembler.out_of_range:
+            self.diagnostics.append(diagnostic(self.starts[i], 0, 0, f"Address {value:#06x} does not fit its field"))
+
+    #Return the word under the cursor
+    def word(self, line_number: int, character: int) -> Optional[str]:
+        i = bisect_right(self.starts, line_number) - 1
+        if i < 0:
+            return None
+        lines = self.assembler.texts[i].split(b"\n")
+        if line_number - self.starts[i] >= len(lines):
+            return None
+        line = lines[line_number - self.starts[i]]
+        if not line.isascii():
+            text = line.decode(errors="replace")
+            character = len(text[:code_points(text, character)].encode())
+        for m in WORD.finditer(line):
+            if m.start() <= character <= m.end():
+                return m.group(0).decode()
+        return None
+
+    #Return the encoding and start address of the assembled line holding line_number
+    def line(self, line_number: int) -> tuple:
+        i = bisect_right(self.starts, line_number) - 1
+        assembler = self.assembler
+        return assembler.lines[i][0], assembler.code_addrs[i]
+
+
+#Line and character of a byte column within a possibly multi-line unit starting at line number
+def position(text: bytes, number: int, column: int) -> tuple:
+    number += text.count(b"\n", 0, column)
+    start = text.rfind(b"\n", 0, column) + 1
+    if text.isascii():
+        return number, column - start
+    return number, utf16_length(text[start:column].decode(errors="replace"))
+
+
+#LSP counts characters in UTF-16 code units, return the length of text in them
+def utf16_length(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+
+#Return the index in line of the character at a column of UTF-16 code units
+def code_points(line: str, character: int) -> int:
+    if line.isascii():
+        return min(character, len(line))
+    units = 0
+    for i, c in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+def diagnostic(line_number: int, character: int, length: int, message: str) -> dict:
+    return {
+        "range": lsp_range(line_number, character, length),
+        "severity": 1,
+        "source": "emisembler",
+        "message": message,
+    }
+
+
+def lsp_range(line_number: int, character: int, length: int) -> dict:
+    return {
+        "start": {"line": line_number, "character": character},
+        "end": {"line": line_number, "character": character + length},
+    }
+
+
+class LanguageServer:
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.documents = {}
+        self.running = True
+
+    #Read one Content-Length framed message, None at end of input
+    def read(self) -> Optional[dict]:
+        length = None
+        while True:
+            header = self.stdin.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.partition(b":")
+            if name.lower() == b"content-length":
+                length = int(value)
+        try:
+            return json.loads(self.stdin.read(length))
+        except ValueError as e:
+            self.send({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": f"Parse error: {e}"}})
+            return {}
+
+    def send(self, message: dict):
+        body = json.dumps(message).encode()
+        self.stdout.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        self.stdout.flush()
+
+    def notify(self, method: str, params: dict):
+        self.send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    #Serve requests until exit or end of input
+    def run(self):
+        while self.running and (message := self.read()) is not None:
+            method = message.get("method")
+            handler = getattr(self, "on_" + method.replace("/", "_"), None) if method else None
+            #A bad message, such as a change to a document that is not open, fails alone rather than the session
+            try:
+                result = handler(message.get("params") or {}) if handler else None
+            except Exception as e:
+                error = f"{method} failed: {type(e).__name__}: {e}"
+                if "id" in message:
+                    self.send({"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32603, "message": error}})
+                else:
+                    self.notify("window/logMessage", {"type": 1, "message": error})
+                continue
+            if "id" in message:
+                if handler is None and method is not None:
+                    self.send({"jsonrpc": "2.0", "id": message["id"],
+                               "error": {"code": -32601, "message": f"Unhandled method {method}"}})
+                else:
+                    self.send({"jsonrpc": "2.0", "id": message["id"], "result": result})
+
+    def on_initialize(self, params: dict) -> dict:
+        return {
+            "capabilities": {
+                "textDocumentSync": 2,
+                "definitionProvider": True,
+                "referencesProvider": True,
+                "hoverProvider": True,
+            },
+            "serverInfo": {"name": "emisembler"},
+        }
+
+    def on_shutdown(self, params: dict):
+        return None
+
+    def on_exit(self, params: dict):
+        self.running = False
+
+    def on_textDocument_didOpen(self, params: dict):
+        uri = params["textDocument"]["uri"]
+        location = urlparse(uri)
+        file = unquote(location.path) if location.scheme == "file" else None
+        self.documents[uri] = Document(params["textDocument"]["text"], file)
+        self.publish(uri)
+
+    def on_textDocument_didChange(self, params: dict):
+        uri = params["textDocument"]["uri"]
+        self.documents[uri].change(params["contentChanges"])
+        self.publish(uri)
+
+    def on_textDocument_didClose(self, params: dict):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.notify("textDocument/publishDiagnostics", {"uri": uri, "diagnostics": []})
+
+    def publish(self, uri: str):
+        self.notify("textDocument/publishDiagnostics",
+                    {"uri": uri, "diagnostics": self.documents[uri].diagnostics})
+
+    def on_textDocument_definition(self, params: dict) -> Optional[dict]:
+        uri = params["textDocument"]["uri"]
+        document = self.documents[uri]
+        label = document.word(params["position"]["line"], params["position"]["character"])
+        if label not in document.definitions:
+            return None
+        line_number, character = document.definitions[label]
+        return {"uri": uri, "range": lsp_range(line_number, character, len(label))}
+
+    def on_textDocument_references(self, params: dict) -> list:
+        uri = params["textDocument"]["uri"]
+        document = self.documents[uri]
+        label = document.word(params["position"]["line"], params["position"]["character"])
+        locations = list(document.references.get(label, ()))
+        if params.get("context", {}).get("includeDeclaration") and label in document.definitions:
+            locations.insert(0, document.definitions[label])
+        return [{"uri": uri, "range": lsp_range(n, c, len(label))} for n, c in locations]
+
+    def on_textDocument_hover(self, params: dict) -> Optional[dict]:
+        uri = params["textDocument"]["uri"]
+        document = self.documents[uri]
+        line_number = params["position"]["line"]
+        label = document.word(line_number, params["position"]["character"])
+        if label in document.assembler.labels:
+            text = f"{label}: {document.assembler.labels[label]:#06x}"
+        else:
+            if not document.starts:
+                return None
+            code, addr = document.line(line_number)
+            if not code:
+                return None
+            encoded = document.assembler.output[addr:addr + len(code)]
+            text = f"{addr:#06x}: {encoded.hex(' ')}"
+        return {"contents": {"kind": "plaintext", "value": text}}
+
+
+if __name__ == "__main__":
+    LanguageServer(sys.stdin.buffer, sys.stdout.buffer).run()
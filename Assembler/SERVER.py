@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import json
+import signal
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import ASSEMBLER
+from LSP import Document
+
+
+#Assembler as an HTTP service, asyncio and the standard library only
+#
+#    POST /assemble              Source in the body, JSON with the image in base64, a listing and LSP diagnostics
+#    POST /assemble?format=bin   The image alone, or the JSON diagnostics with status 422 when it does not assemble
+#    GET  /health                Cache, pool and request counters
+#
+#Assembly runs on a process pool. Requests for a source already being assembled wait for that assembly,
+#and finished results are answered from an LRU cache keyed by the hash of the source.
+
+
+STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable",
+}
+
+#Most headers accepted in one request
+MAX_HEADERS = 64
+
+
+#Request that is answered with an error status instead of being assembled
+class RequestError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+#Worker processes have no files to offer, so .include and .incbin are refused there
+def sandbox():
+    def refuse(path: str):
+        raise SyntaxError(f"Cannot include {path}: includes are disabled in the service")
+    ASSEMBLER.read_include = refuse
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, expire)
+
+
+def expire(signum, frame):
+    raise TimeoutError
+
+
+#Return "address  bytes  source" lines of the assembled lines, at most 8 bytes are shown per line
+def listing(assembler) -> str:
+    lines = []
+    for i, (text, line) in enumerate(zip(assembler.texts, assembler.lines)):
+        source = text.decode(errors="replace").rstrip("\r\n").split("\n")
+        addr, length = (assembler.code_addrs[i], len(line[0])) if line[0] else (assembler.data_addrs[i], len(line[1]))
+        if length:
+            shown = assembler.output[addr:addr + min(length, 8)].hex(" ") + (" .." if length > 8 else "")
+            lines.append(f"{addr:04x}  {shown:<27} {source[0]}")
+        else:
+            lines.append(f"{'':<33} {source[0]}")
+        lines += [f"{'':<33} {s}" for s in source[1:]]
+    return "\n".join(lines) + "\n"
+
+
+#Assemble source in a worker process within limit seconds and return (image or None, JSON body)
+def build(source: bytes, limit: float) -> tuple:
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, limit)
+    try:
+        document = Document(source.decode(errors="replace"))
+    except TimeoutError:
+        raise
+    except Exception as e:
+        #Anything the assembler does not report as a SyntaxError, such as runaway macro recursion
+        return None, json.dumps({"image": None, "listing": "", "error": f"{type(e).__name__}: {e}",
+                                 "diagnostics": []}).encode()
+    finally:
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        #Workers live on, so the parse caches would otherwise keep every operand and macro any client sent
+        ASSEMBLER.EXPRESSIONS.clear()
+        ASSEMBLER.EXPANSIONS.clear()
+        ASSEMBLER.REPLAYS.clear()
+    image = None if document.error else bytes(document.assembler.output)
+    body = {
+        "image": base64.b64encode(image).decode() if image is not None else None,
+        "listing": listing(document.assembler) if image is not None else "",
+        "error": document.error,
+        "diagnostics": document.diagnostics,
+    }
+    return image, json.dumps(body).encode()
+
+
+class AssemblerService:
+
+    #Constructor starts workers processes, limit is in seconds and max_body in bytes
+    def __init__(self, workers: Optional[int] = None, cache_size: int = 256, max_body: int = 1 << 20,
+                 limit: float = 5.0):
+        self.workers = workers
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=sandbox)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.max_body = max_body
+        self.limit = limit
+        #Assemblies in progress by source hash, shared by identical requests
+        self.running = {}
+        self.counters = dict.fromkeys(("requests", "hits", "shared", "assembled", "timeouts", "rejected", "restarts"), 0)
+
+    #Return (image or None, JSON body) of source from the cache, from an assembly already running or a new one
+    async def result(self, source: bytes) -> tuple:
+        key = hashlib.blake2b(source, digest_size=16).digest()
+        if (result := self.cache.get(key)) is not None:
+            self.cache.move_to_end(key)
+            self.counters["hits"] += 1
+            return result
+        future = self.running.get(key)
+        if future is None:
+            pool = self.pool
+            try:
+                future = asyncio.get_running_loop().run_in_executor(pool, build, source, self.limit)
+            except concurrent.futures.BrokenExecutor:
+                #The pool broke before this request reached it, so the request goes to the replacement
+                self.restart(pool)
+                pool = self.pool
+                future = asyncio.get_running_loop().run_in_executor(pool, build, source, self.limit)
+            future.add_done_callback(lambda f: self.finish(key, f, pool))
+            self.running[key] = future
+            self.counters["assembled"] += 1
+        else:
+            self.counters["shared"] += 1
+        #The worker stops itself at the limit, the margin covers the trip to and from it
+        return await asyncio.wait_for(asyncio.shield(future), self.limit + 1.0)
+
+    #Cache a finished assembly, evicting the least recently used results beyond cache_size
+    def finish(self, key: bytes, future: asyncio.Future, pool: concurrent.futures.Executor):
+        del self.running[key]
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), concurrent.futures.BrokenExecutor):
+            self.restart(pool)
+        if future.exception() is not None:
+            return
+        self.cache[key] = future.result()
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    #Replace a pool whose worker died, as when the kernel kills one that ran out of memory, the requests it was
+    #running fail but later ones are served
+    def restart(self, pool: concurrent.futures.Executor):
+        if pool is not self.pool:
+            return
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=sandbox)
+        self.counters["restarts"] += 1
+
+    def health(self) -> dict:
+        return dict(self.counters, cached=len(self.cache), running=len(self.running))
+
+    #Read one request as (method, target, headers, body), None once the client closed the connection
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[tuple]:
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise RequestError(400, "Malformed request line")
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            if len(headers) >= MAX_HEADERS:
+                raise RequestError(431, "Too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise RequestError(411, "Send the source with a Content-Length")
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise RequestError(400, "Invalid Content-Length")
+        if length > self.max_body:
+            raise RequestError(413, f"Source is larger than {self.max_body} bytes")
+        return parts[0], parts[1], headers, await reader.readexactly(length)
+
+    #Return (status, content type, body) for a request
+    async def respond(self, method: str, target: str, body: bytes) -> tuple:
+        url = urlparse(target)
+        if url.path == "/health":
+            if method != "GET":
+                raise RequestError(405, "Use GET for /health")
+            return 200, "application/json", json.dumps(self.health()).encode()
+        if url.path != "/assemble":
+            raise RequestError(404, f"No such endpoint {url.path}")
+        if method != "POST":
+            raise RequestError(405, "POST the source to /assemble")
+        output = parse_qs(url.query).get("format", ["json"])[0]
+        if output not in ("json", "bin"):
+            raise RequestError(400, f"Unknown format {output}, use json or bin")
+        try:
+            image, result = await self.result(body)
+        except (asyncio.TimeoutError, TimeoutError):
+            self.counters["timeouts"] += 1
+            raise RequestError(503, f"Assembly took longer than {self.limit} s")
+        except concurrent.futures.BrokenExecutor:
+            raise RequestError(503, "Assembler worker failed")
+        if image is None:
+            return 422, "application/json", result
+        if output == "bin":
+            return 200, "application/octet-stream", image
+        return 200, "application/json", result
+
+    #Serve requests on a connection until the client closes it or asks to
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.limit)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    self.counters["requests"] += 1
+                    status, content_type, payload = await self.respond(method, target, body)
+                    close = headers.get("connection", "").lower() == "close"
+                except RequestError as e:
+                    self.counters["rejected"] += 1
+                    status, content_type, payload = e.status, "application/json", json.dumps({"error": str(e)}).encode()
+                    close = True
+                except ValueError:
+                    #Line longer than the stream buffer
+                    self.counters["rejected"] += 1
+                    status, content_type, payload = 431, "application/json", b'{"error": "Header line too long"}'
+                    close = True
+                writer.write(f"HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\nConnection: {'close' if close else 'keep-alive'}\r\n\r\n"
+                             .encode() + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        #SIGTERM stops serving like Ctrl-C does, so the pool is shut down instead of leaving workers that hold the port
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        except (AttributeError, NotImplementedError):
+            pass
+        print(f"Serving on http://{host}:{server.sockets[0].getsockname()[1]}", flush=True)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on, 0 picks a free one")
+    parser.add_argument("--workers", type=int, help="assembler processes, one per CPU by default")
+    parser.add_argument("--cache", type=int, default=256, help="results kept in the LRU cache")
+    parser.add_argument("--max-body", type=int, default=1 << 20, help="largest source accepted, in bytes")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds allowed for reading and assembling a request")
+    args = parser.parse_args()
+
+    service = AssemblerService(args.workers, args.cache, args.max_body, args.timeout)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,115 @@
+import argparse
+import random
+
+
+#Synthetic Emisembler sources for benchmarking the assembler
+#
+#    lines           Number of source lines
+#    label_density   Fraction of lines that define a label
+#    forward_ratio   Fraction of branches that target a label defined later
+#    comment_ratio   Fraction of lines that are comments
+#    ascii_ratio     Fraction of lines that are .ascii directives
+
+
+#Instructions without label operands, {r} is a register, {p} a register pair, {i} an 8 bit immediate
+INSTRUCTIONS = [
+    "LDI R{r}, {i:#04x}",
+    "LD R{r}, {a:#06x}",
+    "ST R{r}, {a:#06x}",
+    "MOV R{r}, R{s}",
+    "ADD R{r}, R{s}, R{t}",
+    "ADC R{r}, R{s}, R{t}",
+    "AND R{r}, R{s}, R{t}",
+    "OR R{r}, R{s}, R{t}",
+    "XOR R{r}, R{s}, R{t}",
+    "NOT R{r}, R{s}",
+    "OUT R{r}",
+    "OUTA R{r}",
+    "OUTP R{p}",
+    "CPI R{r}, {i}",
+    "ADDI R{r}, {i:#04x}",
+    "ADDIW R{p}, {a:#06x}",
+    "LDIR R{r}, (R{s})",
+    "STIR (R{r}), R{s}",
+    "LDIRP R{r}, (R{p})",
+    "STIRP (R{p}), R{r}",
+    "HLT",
+    "RET",
+]
+
+BRANCHES = ["JMP", "BEQ", "BGT", "BLT", "CALL"]
+
+COMMENTS = [
+    "# {w}",
+    "// {w}",
+    "/* {w} */",
+]
+
+WORKLOADS = {
+    "mixed": dict(label_density=0.1, forward_ratio=0.5),
+    "labels": dict(label_density=0.5, forward_ratio=0.5),
+    "forward": dict(label_density=0.1, forward_ratio=1.0),
+    "comments": dict(label_density=0.05, forward_ratio=0.5, comment_ratio=0.7),
+    "ascii": dict(label_density=0.05, forward_ratio=0.5, ascii_ratio=0.5),
+}
+
+
+#Return a source of the given number of lines
+def generate(lines: int, label_density: float = 0.1, forward_ratio: float = 0.5,
+             comment_ratio: float = 0.0, ascii_ratio: float = 0.0, branch_ratio: float = 0.2,
+             seed: int = 0) -> str:
+    rng = random.Random(seed)
+    defines = [i == 0 or rng.random() < label_density for i in range(lines)]
+    #Index of the next label defined at or after each line, for forward branches
+    upcoming = [None] * (lines + 1)
+    for i in range(lines - 1, -1, -1):
+        upcoming[i] = i if defines[i] else upcoming[i + 1]
+
+    out = []
+    previous = None
+    for i in range(lines):
+        if defines[i]:
+            out.append(f"L{i}:")
+            previous = i
+            continue
+        kind = rng.random()
+        if kind < comment_ratio:
+            words = " ".join(rng.choice(("loop", "counter", "value", "result", "byte")) for _ in range(6))
+            out.append("    " + rng.choice(COMMENTS).format(w=words))
+        elif kind < comment_ratio + ascii_ratio:
+            text = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ !") for _ in range(rng.randrange(4, 24)))
+            out.append(f'.ascii "{text}\\n"')
+        elif rng.random() < branch_ratio:
+            target = upcoming[i + 1] if rng.random() < forward_ratio else previous
+            if target is None:
+                target = previous if upcoming[i + 1] is None else upcoming[i + 1]
+            out.append(f"    {rng.choice(BRANCHES)} L{target}")
+        else:
+            out.append("    " + rng.choice(INSTRUCTIONS).format(
+                r=rng.randrange(4), s=rng.randrange(4), t=rng.randrange(4),
+                p=rng.choice(("01", "23")), i=rng.randrange(256), a=rng.randrange(0x4000)))
+    return "\n".join(out) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1000, help="number of source lines")
+    parser.add_argument("--workload", choices=WORKLOADS, default="mixed", help="preset parameters")
+    parser.add_argument("--label-density", type=float, help="fraction of lines defining a label")
+    parser.add_argument("--forward-ratio", type=float, help="fraction of branches to later labels")
+    parser.add_argument("--comment-ratio", type=float, help="fraction of comment lines")
+    parser.add_argument("--ascii-ratio", type=float, help="fraction of .ascii lines")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-o", "--output", help="write to file instead of stdout")
+    args = parser.parse_args()
+
+    params = dict(WORKLOADS[args.workload])
+    for name in ("label_density", "forward_ratio", "comment_ratio", "ascii_ratio"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    source = generate(args.lines, seed=args.seed, **params)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(source)
+    else:
+        print(source, end="")
@@ -0,0 +1,38 @@
+/*
+    Bubble sort the 16 bytes at 0x00-0x0F using LDIR/STIR
+    R0 is the index, R1 and R2 hold the neighbouring values
+    The swapped flag is kept in memory at 0x3FFF
+*/
+.ascii "PONMLKJIHGFEDCBA"
+OUTER:
+    LDI R0, 0x00
+    LDI R3, 0x00
+    ST R3, 0x3FFF #Clear swapped flag
+INNER:
+    LDIR R1, (R0)
+    ADDI R0, 0x01
+    LDIR R2, (R0)
+    NOT R3, R1
+    ADD R3, R3, R2
+    ADDI R3, 0x01 #R3 = a[i+1] - a[i]
+    CPI R3, 0x00
+    BLT SWAP #Out of order
+    JMP NEXT
+SWAP:
+    STIR (R0), R1
+    ADDI R0, 0xFF
+    STIR (R0), R2
+    ADDI R0, 0x01
+    LDI R3, 0x01
+    ST R3, 0x3FFF #Set swapped flag
+NEXT:
+    CPI R0, 0x0F
+    BEQ PASS
+    JMP INNER
+PASS:
+    LD R3, 0x3FFF
+    CPI R3, 0x00
+    BEQ END #No swaps, sorted
+    JMP OUTER
+END:
+    HLT
@@ -0,0 +1,14 @@
+/*
+    Count R01 from 0x0000 to 0x1000 with ADDIW and print every value
+    R0 holds the high byte of the pair
+*/
+LDI R0, 0x00
+LDI R1, 0x00
+LOOP:
+    OUTP R01
+    ADDIW R01, 0x0001
+    CPI R0, 0x10 #Stop once the high byte reaches 0x10
+    BEQ END
+    JMP LOOP
+END:
+    HLT
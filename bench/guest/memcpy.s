@@ -0,0 +1,20 @@
+/*
+    Copy 256 bytes from 0x0000 to 0x0100 with LDIRP/STIRP
+    R01 walks the source, the destination is reached by offsetting the same pair
+    R3 counts down the bytes left
+*/
+.ascii "The quick brown fox jumps over the lazy dog. 0123456789"
+LDI R0, 0x00
+LDI R1, 0x00
+LDI R3, 0x00
+LOOP:
+    LDIRP R2, (R01) #Load source byte
+    ADDIW R01, 0x0100 #Move to destination
+    STIRP (R01), R2 #Store it
+    ADDIW R01, 0xFF01 #Back to the next source byte
+    ADDI R3, 0xFF
+    CPI R3, 0x00
+    BEQ END
+    JMP LOOP
+END:
+    HLT
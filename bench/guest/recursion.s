@@ -0,0 +1,15 @@
+/*
+    Recurse 200 calls deep, printing the depth on the way back up
+*/
+LDI R0, 0xC8
+CALL DOWN
+HLT
+DOWN:
+    CPI R0, 0x00
+    BEQ BOTTOM
+    ADDI R0, 0xFF
+    CALL DOWN #Recurse with depth - 1
+    ADDI R0, 0x01
+    OUT R0
+BOTTOM:
+    RET
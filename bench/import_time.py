@@ -0,0 +1,51 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSEMBLER = os.path.join(ROOT, "Assembler")
+
+
+#Startup cost of the assembler for short CLI invocations
+#
+#    interpreter     python -c pass
+#    import          python -c "import ASSEMBLER", minus the interpreter
+#    grammar         compiling the instruction grammar on first use, in process
+
+
+#Median wall time of running code in a fresh interpreter
+def run(code: str, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ASSEMBLER, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+#Median time to build the grammar from scratch
+def grammar_time(runs: int) -> float:
+    sys.path.insert(0, ASSEMBLER)
+    import ASSEMBLER as assembler
+    times = []
+    for _ in range(runs):
+        assembler.GRAMMAR.clear()
+        start = time.perf_counter()
+        assembler.grammar()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20, help="interpreter launches per measurement")
+    args = parser.parse_args()
+
+    interpreter = run("pass", args.runs)
+    imported = run("import ASSEMBLER", args.runs)
+    print(f"interpreter {interpreter * 1000:8.2f} ms")
+    print(f"import      {(imported - interpreter) * 1000:8.2f} ms")
+    print(f"grammar     {grammar_time(args.runs) * 1000:8.2f} ms")
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import generate
+
+
+#Load generator for the assembler service in Assembler/SERVER.py
+#
+#    concurrency     Connections kept open, each sending its next request as soon as the last is answered
+#    unique          Fraction of requests with a source not sent before, the rest repeat earlier sources
+#    spawn           Start a local server for the run instead of using one already listening
+
+
+#Send payloads on one keep-alive connection, appending each latency in seconds
+async def client(host: str, port: int, target: str, payloads: list, latencies: list, errors: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for payload in payloads:
+            start = time.perf_counter()
+            writer.write(f"POST {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+                         + payload)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while (line := await reader.readline()) != b"\r\n":
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+#Return the sources sent, repeating earlier ones so that about unique of them are new
+def payloads(count: int, unique: float, lines: int) -> list:
+    sources = []
+    distinct = 0
+    for i in range(count):
+        if distinct == 0 or distinct < unique * (i + 1):
+            sources.append(generate(lines, seed=distinct).encode())
+            distinct += 1
+        else:
+            sources.append(sources[i * 7919 % len(sources)])
+    return sources
+
+
+#Start SERVER.py on port and wait until it accepts connections
+async def spawn(host: str, port: int, workers: int) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(ROOT, "Assembler", "SERVER.py"), "--host", host, "--port", str(port)]
+    if workers:
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, cwd=os.path.join(ROOT, "Assembler"), stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return server
+        except OSError:
+            await asyncio.sleep(0.1)
+    server.kill()
+    raise SystemExit(f"Server did not start listening on {host}:{port}")
+
+
+async def main(args):
+    sources = payloads(args.requests, args.unique, args.lines)
+    target = "/assemble?format=bin" if args.format == "bin" else "/assemble"
+    server = await spawn(args.host, args.port, args.workers) if args.spawn else None
+    try:
+        latencies, errors = [], []
+        start = time.perf_counter()
+        await asyncio.gather(*(client(args.host, args.port, target, sources[i::args.concurrency], latencies, errors)
+                               for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    print(f"requests    {len(latencies):8d}")
+    print(f"errors      {len(errors):8d}")
+    print(f"throughput  {len(latencies) / elapsed:8.1f} req/s")
+    print(f"p50         {percentiles[49] * 1000:8.2f} ms")
+    print(f"p99         {percentiles[98] * 1000:8.2f} ms")
+    print(f"max         {max(latencies) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server")
+    parser.add_argument("--port", type=int, default=8080, help="port of the server")
+    parser.add_argument("--requests", type=int, default=1000, help="total requests sent")
+    parser.add_argument("--concurrency", type=int, default=16, help="connections sending requests at once")
+    parser.add_argument("--unique", type=float, default=0.1, help="fraction of requests with a new source")
+    parser.add_argument("--lines", type=int, default=200, help="source lines per request")
+    parser.add_argument("--format", choices=("json", "bin"), default="json", help="response format requested")
+    parser.add_argument("--spawn", action="store_true", help="start a local server for the run")
+    parser.add_argument("--workers", type=int, help="worker processes of the spawned server")
+    args = parser.parse_args()
+    asyncio.run(main(args))
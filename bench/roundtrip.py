@@ -0,0 +1,90 @@
+import argparse
+import concurrent.futures
+import io
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Assembler"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ASSEMBLER import AssemblyParser
+from DISASSEMBLER import Disassembler, verify
+from generate import generate
+
+
+#Round-trip harness for the assembler and disassembler
+#
+#    Random programs built from the generator's instructions, branches, comments and .ascii lines are assembled,
+#    disassembled and assembled again, and the two images must match byte for byte. Each program is also streamed
+#    through the parser in chunks of a few bytes, which must give the same image as parsing it whole. Programs are
+#    numbered by seed, so a failure is reproduced with --seed N --programs 1.
+
+
+#Return a description of how the program of seed fails to round-trip, or None when it does
+def check(seed: int, lines: int) -> Optional[str]:
+    rng = random.Random(seed)
+    source = generate(rng.randrange(1, lines + 1), label_density=rng.random() * 0.3, forward_ratio=rng.random(),
+                      comment_ratio=rng.random() * 0.2, ascii_ratio=rng.random() * 0.1, seed=seed)
+    #Without a final HLT execution falls through the zeroed rest of the code area, which disassembles as NOPs,
+    #most programs stop so that the few open ended ones keep labels past the last non-zero byte covered
+    if rng.random() < 0.9:
+        source += "    HLT\n"
+    p = AssemblyParser()
+    p.verbose = False
+    p.current_input = source.encode()
+    try:
+        p.parse_program()
+        p.resolve_labels()
+        image = bytes(p.output)
+        #Tiny chunks end the buffer after nearly every line and inside block comments and strings
+        s = AssemblyParser()
+        s.verbose = False
+        s.CHUNK_SIZE = rng.randrange(1, 17)
+        s.LOOKAHEAD = rng.randrange(1, s.CHUNK_SIZE + 1)
+        s.source = io.BytesIO(source.encode())
+        s.parse_program()
+        s.resolve_labels()
+        if s.output != p.output:
+            mismatch = next(addr for addr in range(len(image)) if s.output[addr] != image[addr])
+            return f"seed {seed}: streamed in chunks of {s.CHUNK_SIZE} bytes, image differs at {mismatch:#06x}"
+        text = Disassembler(image).disassemble()
+        mismatch = verify(text, image)
+    except SyntaxError as e:
+        return f"seed {seed}: {e}"
+    if mismatch is not None:
+        return f"seed {seed}: reassembled image differs at {mismatch:#06x}"
+    return None
+
+
+#Check a run of consecutive seeds, returning the failures
+def check_range(start: int, count: int, lines: int) -> list:
+    return [failure for seed in range(start, start + count) if (failure := check(seed, lines)) is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--programs", type=int, default=10000, help="random programs checked")
+    parser.add_argument("--lines", type=int, default=200, help="most source lines in a program")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first program")
+    parser.add_argument("--workers", type=int, help="processes checking programs, one per CPU by default")
+    args = parser.parse_args()
+
+    batch = 50
+    start = time.perf_counter()
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        batches = [pool.submit(check_range, seed, min(batch, args.seed + args.programs - seed), args.lines)
+                   for seed in range(args.seed, args.seed + args.programs, batch)]
+        for future in batches:
+            failures += future.result()
+    elapsed = time.perf_counter() - start
+
+    for failure in failures[:20]:
+        print(failure)
+    print(f"{args.programs} programs, {len(failures)} failed, {args.programs / elapsed * 60:.0f} programs/min")
+    if failures:
+        raise SystemExit(1)
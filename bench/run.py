@@ -0,0 +1,166 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Assembler"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ASSEMBLER import AssemblyParser
+from generate import WORKLOADS, generate
+
+
+#Times each assembler phase on generated workloads and keeps a JSON history of the results
+#
+#    parse       parse_program over the memory-mapped source
+#    resolve     resolve_labels
+#    write       writing the image to disk
+
+PHASES = ("parse", "resolve", "write")
+
+
+#Large workloads branch past 16-bit addresses, which are timed rather than rejected
+class BenchParser(AssemblyParser):
+
+    def check_address(self, value: int, offset: int, length: int, shift: int, mask: int):
+        pass
+
+
+#Assemble path once and return seconds spent in each phase
+def time_phases(path: str, lines: int) -> dict:
+    p = BenchParser()
+    p.verbose = False
+    #Large workloads do not fit the 64 KiB address space, give them a bigger image to time against
+    if lines > 1000:
+        p.output = bytearray(0x10000 + 64 * lines)
+        p.mem_addr = 0x8000 + 4 * lines
+    with open(path, "rb") as i:
+        p.current_input = mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ)
+        start = time.perf_counter()
+        p.parse_program()
+        parsed = time.perf_counter()
+        p.current_input.close()
+    p.resolve_labels()
+    resolved = time.perf_counter()
+    with tempfile.TemporaryFile() as f:
+        f.write(p.output)
+    written = time.perf_counter()
+    return {"parse": parsed - start, "resolve": resolved - parsed, "write": written - resolved}
+
+
+#Best of repeat runs for each workload and size
+def run(workloads: list, sizes: list, repeat: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for workload in workloads:
+            results[workload] = {}
+            for lines in sizes:
+                path = os.path.join(tmp, f"{workload}_{lines}.s")
+                with open(path, "w") as f:
+                    f.write(generate(lines, **WORKLOADS[workload]))
+                best = None
+                for _ in range(repeat):
+                    times = time_phases(path, lines)
+                    best = times if best is None else {k: min(best[k], times[k]) for k in PHASES}
+                best["total"] = sum(best[k] for k in PHASES)
+                results[workload][str(lines)] = best
+                print(f"{workload:>10} {lines:>9} lines  " +
+                      "  ".join(f"{k} {best[k] * 1000:10.2f} ms" for k in PHASES + ("total",)))
+    return results
+
+
+#Exponent of the total time fitted between the smallest and largest size, 1.0 is linear
+def scaling(results: dict) -> dict:
+    exponents = {}
+    for workload, sizes in results.items():
+        ordered = sorted(sizes, key=int)
+        if len(ordered) < 2:
+            continue
+        small, large = ordered[0], ordered[-1]
+        ratio = sizes[large]["total"] / max(sizes[small]["total"], 1e-9)
+        exponents[workload] = math.log(ratio) / math.log(int(large) / int(small))
+    return exponents
+
+
+#Return phases that got slower than the baseline by more than threshold
+def compare(baseline: dict, results: dict, threshold: float) -> list:
+    regressions = []
+    for workload, sizes in results.items():
+        for lines, times in sizes.items():
+            old = baseline.get(workload, {}).get(lines)
+            if old is None:
+                continue
+            for phase in PHASES + ("total",):
+                #Ignore sub-millisecond phases, they are dominated by timer noise
+                if old[phase] < 0.001:
+                    continue
+                change = times[phase] / old[phase] - 1
+                if change > threshold:
+                    regressions.append((workload, lines, phase, old[phase], times[phase], change))
+    return regressions
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="source sizes in lines")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS), help="workloads to run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest is kept")
+    parser.add_argument("--history", default=os.path.join(ROOT, "bench", "history.json"), help="JSON history file")
+    parser.add_argument("--compare", action="store_true", help="compare against the last recorded run")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown reported as a regression")
+    parser.add_argument("--max-exponent", type=float, default=1.15, help="largest scaling exponent accepted as linear")
+    parser.add_argument("--no-save", action="store_true", help="do not append this run to the history")
+    args = parser.parse_args()
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    results = run(args.workloads, args.sizes, args.repeat)
+    failed = False
+
+    exponents = scaling(results)
+    for workload, exponent in exponents.items():
+        linear = exponent <= args.max_exponent
+        failed |= not linear
+        print(f"{workload:>10} scales as n^{exponent:.2f}{'' if linear else '  NOT LINEAR'}")
+
+    if args.compare:
+        if not history:
+            print("No previous run to compare against")
+        else:
+            baseline = history[-1]
+            regressions = compare(baseline["results"], results, args.threshold)
+            for workload, lines, phase, old, new, change in regressions:
+                print(f"REGRESSION {workload} {lines} lines {phase}: {old * 1000:.2f} ms → {new * 1000:.2f} ms (+{change:.0%})")
+            if not regressions:
+                print(f"No regressions against {baseline['commit']} beyond {args.threshold:.0%}")
+            failed |= bool(regressions)
+
+    if not args.no_save:
+        history.append({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit(),
+            "python": platform.python_version(),
+            "results": results,
+        })
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=1)
+
+    sys.exit(1 if failed else 0)